@@ -0,0 +1,113 @@
+"""
+Show how much chat persistence stalls the event loop, for the sync pymongo
+calls the chat service used to make inline and for AsyncChatMessagesDatabase.
+
+Each simulated client runs chat turns the way ChatManager does (log the
+user message, log the reply, read the session history) while a probe task
+asks to wake up every --probe-ms; the probe's oversleep is the time the loop
+was blocked and every other connected client was kept waiting.
+
+Run from the chat directory against a local MongoDB (MONGO_URL):
+
+    python -m benchmarks.event_loop_stall --clients 1,16,64 --turns 20
+"""
+import argparse
+import asyncio
+import logging
+import time
+import uuid
+
+from core.async_sessions import AsyncChatMessagesDatabase
+from core.schema import ChatMessage
+from core.sessions import ChatMessagesDatabase
+
+BENCH_COLLECTION = 'messages_bench'
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def probe(interval, lags, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+def turn_messages(session_id):
+    return [
+        ChatMessage(session_id=session_id, message_json={'text': 'What is 2 + 2?'}, type='user'),
+        ChatMessage(session_id=session_id, message_json={'response': 'The answer is 4'}, type='system'),
+    ]
+
+
+async def sync_client(db, turns):
+    session_id = str(uuid.uuid4())
+    for _ in range(turns):
+        for message in turn_messages(session_id):
+            db.insert(message)
+        db.query_by_session(session_id)
+        await asyncio.sleep(0)
+
+
+async def async_client(db, turns):
+    session_id = str(uuid.uuid4())
+    for _ in range(turns):
+        for message in turn_messages(session_id):
+            await db.insert(message)
+        await db.query_by_session(session_id)
+
+
+async def run_once(mode, db, clients, args):
+    lags = []
+    stop = asyncio.Event()
+    prober = asyncio.create_task(probe(args.probe_ms / 1000, lags, stop))
+    client = sync_client if mode == 'sync' else async_client
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(db, args.turns) for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await prober
+
+    print('%-6s %8d %10.0f %10.1f %10.1f %10.1f' % (
+        mode, clients, clients * args.turns / elapsed,
+        percentile(lags, 0.5) * 1000, percentile(lags, 0.99) * 1000, max(lags, default=0.0) * 1000
+    ))
+
+
+async def run(args):
+    sync_db = ChatMessagesDatabase()
+    sync_db.collection = sync_db.db[BENCH_COLLECTION]
+    sync_db.collection.create_index('session_id')
+    databases = {'sync': sync_db, 'async': AsyncChatMessagesDatabase(sync_db)}
+
+    # the per-message log lines would dominate the timings
+    logging.getLogger('core.sessions').setLevel(logging.WARNING)
+    print('%-6s %8s %10s %10s %10s %10s' % ('mode', 'clients', 'turns/sec', 'lag p50', 'lag p99', 'lag max'))
+    try:
+        for clients in args.clients:
+            for mode in args.modes:
+                await run_once(mode, databases[mode], clients, args)
+    finally:
+        sync_db.collection.drop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', default='1,16,64', help="comma-separated concurrent client counts")
+    parser.add_argument('--turns', type=int, default=20, help="chat turns per client")
+    parser.add_argument('--modes', default='sync,async')
+    parser.add_argument('--probe-ms', type=float, default=5, help="probe wake-up interval in milliseconds")
+    args = parser.parse_args()
+    args.clients = [int(c) for c in args.clients.split(',')]
+    args.modes = args.modes.split(',')
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
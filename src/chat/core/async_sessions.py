@@ -0,0 +1,90 @@
+import asyncio
+import functools
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Dict, Any, Optional
+from .schema import ChatSession, ChatMessage
+from .sessions import (
+    ChatSessionDatabase, ChatMessagesDatabase, WriteBehindChatMessagesDatabase, create_messages_database
+)
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Thread pool shared by the async databases, sized by CHAT_DB_THREADS.
+    pymongo clients are thread-safe and pool their own connections, so the
+    threads only bound how many round trips are in flight at once.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("CHAT_DB_THREADS", "16")),
+            thread_name_prefix="chat-db"
+        )
+    return _executor
+
+
+class _AsyncDatabase:
+    def __init__(self, database, executor: Optional[ThreadPoolExecutor] = None):
+        self.sync = database
+        self.executor = executor or get_executor()
+
+    async def _run(self, method, *args) -> Tuple[bool, Any]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(method, *args))
+
+
+class AsyncChatSessionDatabase(_AsyncDatabase):
+    """ChatSessionDatabase for async callers; every call runs on the chat-db thread pool."""
+
+    def __init__(self, database: Optional[ChatSessionDatabase] = None, executor: Optional[ThreadPoolExecutor] = None):
+        super().__init__(database or ChatSessionDatabase(), executor)
+
+    async def insert(self, session: ChatSession) -> Tuple[bool, Any]:
+        return await self._run(self.sync.insert, session)
+
+    async def update(self, session_id: str, update_fields: Dict[str, Any]) -> Tuple[bool, Any]:
+        return await self._run(self.sync.update, session_id, update_fields)
+
+    async def delete(self, session_id: str) -> Tuple[bool, Any]:
+        return await self._run(self.sync.delete, session_id)
+
+    async def query(self, query_filter: Dict[str, Any]) -> Tuple[bool, Any]:
+        return await self._run(self.sync.query, query_filter)
+
+    async def get_by_session_id(self, session_id: str) -> Tuple[bool, Any]:
+        return await self._run(self.sync.get_by_session_id, session_id)
+
+
+class AsyncChatMessagesDatabase(_AsyncDatabase):
+    """ChatMessagesDatabase for async callers; every call runs on the chat-db thread pool."""
+
+    def __init__(self, database: Optional[ChatMessagesDatabase] = None, executor: Optional[ThreadPoolExecutor] = None):
+        super().__init__(database or create_messages_database(), executor)
+
+    async def insert(self, message: ChatMessage) -> Tuple[bool, Any]:
+        return await self._run(self.sync.insert, message)
+
+    async def query_by_session(self, session_id: str) -> Tuple[bool, Any]:
+        return await self._run(self.sync.query_by_session, session_id)
+
+    async def get_by_chat_id(self, chat_id: str) -> Tuple[bool, Any]:
+        return await self._run(self.sync.get_by_chat_id, chat_id)
+
+    async def delete_by_chat_id(self, chat_id: str) -> Tuple[bool, Any]:
+        return await self._run(self.sync.delete_by_chat_id, chat_id)
+
+    def stats(self) -> Optional[Dict[str, Any]]:
+        """Write-behind buffer stats, or None when inserts are written directly."""
+        if isinstance(self.sync, WriteBehindChatMessagesDatabase):
+            return self.sync.stats()
+        return None
+
+    async def close(self):
+        if isinstance(self.sync, WriteBehindChatMessagesDatabase):
+            await self._run(self.sync.close)
@@ -1,16 +1,16 @@
 import time
 import uuid
 import logging
-from typing import Dict, Any
+from typing import Any, AsyncIterator, Dict
 from .proxy import ChatProxyRouter
 from .schema import ChatMessage
-from .sessions import ChatMessagesDatabase
+from .async_sessions import AsyncChatMessagesDatabase
 
 logger = logging.getLogger(__name__)
 
 
 class ChatManager:
-    def __init__(self, chat_proxy_router: ChatProxyRouter, message_db: ChatMessagesDatabase):
+    def __init__(self, chat_proxy_router: ChatProxyRouter, message_db: AsyncChatMessagesDatabase):
         self.proxy = chat_proxy_router
         self.db = message_db
 
@@ -27,7 +27,7 @@ class ChatManager:
             timestamp=int(time.time())
         )
 
-        success, result = self.db.insert(user_msg)
+        success, result = await self.db.insert(user_msg)
         if not success:
             logger.warning(f"Failed to log user message: {result}")
 
@@ -49,9 +49,55 @@ class ChatManager:
             timestamp=int(time.time())
         )
 
-        success, result = self.db.insert(system_msg)
+        success, result = await self.db.insert(system_msg)
         if not success:
             logger.warning(f"Failed to log system message: {result}")
 
         # Step 4: Return response
         return response_json
+
+    async def stream_message(self, session_id: str, subject_id: str, message_json: Dict[str, Any], file_urls: Dict[str, str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Like handle_message, but yields the subject's `{"delta": ...}` frames as
+        they arrive and finally the assembled response with `"done": true`.
+        Only the assembled response is persisted, once the stream has ended.
+        """
+        file_urls = file_urls or {}
+
+        user_msg = ChatMessage(
+            chat_id=str(uuid.uuid4()),
+            session_id=session_id,
+            message_json=message_json,
+            file_urls=file_urls,
+            type="user",
+            timestamp=int(time.time())
+        )
+
+        success, result = await self.db.insert(user_msg)
+        if not success:
+            logger.warning(f"Failed to log user message: {result}")
+
+        frames = self.proxy.stream_message(subject_id, message_json)
+        try:
+            async for frame in frames:
+                if frame.get("done"):
+                    response_json = {k: v for k, v in frame.items() if k != "done"}
+                    system_msg = ChatMessage(
+                        chat_id=str(uuid.uuid4()),
+                        session_id=session_id,
+                        message_json=response_json,
+                        file_urls={},
+                        type="system",
+                        timestamp=int(time.time())
+                    )
+
+                    success, result = await self.db.insert(system_msg)
+                    if not success:
+                        logger.warning(f"Failed to log system message: {result}")
+                yield frame
+        except Exception as e:
+            logger.error(
+                f"Error streaming message from subject {subject_id}: {e}")
+            raise
+        finally:
+            await frames.aclose()
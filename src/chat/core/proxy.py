@@ -1,63 +1,308 @@
 import asyncio
+import os
 import websockets
 import json
 import logging
-from typing import Dict
+import uuid
+from typing import AsyncIterator, Dict, Optional, Union
 
-import requests
+import aiohttp
 
 logger = logging.getLogger(__name__)
 
 
+def final_frame(frame: dict) -> bool:
+    # a subject that does not stream answers with one plain response
+    return bool(frame.get("done")) or "delta" not in frame
+
+
+def stream_frame(raw) -> dict:
+    frame = json.loads(raw)
+    if not isinstance(frame, dict):
+        raise ValueError(f"Expected a JSON object stream frame, got {type(frame).__name__}")
+    return frame
+
+
 class ChatWebSocketClient:
-    def __init__(self, chat_url: str):
+    """
+    One WebSocket to a subject. By default a push holds the connection until
+    the subject answers. With multiplexing (CHAT_WS_MULTIPLEX) each request
+    carries a `correlation_id` that the subject echoes back, a background
+    reader resolves the matching request, and up to CHAT_WS_MAX_IN_FLIGHT
+    requests share the connection. A multiplexed request that gets no
+    response within CHAT_RESPONSE_TIMEOUT seconds fails with
+    asyncio.TimeoutError, and a late response to it is dropped.
+
+    `stream` asks the subject for incremental `{"delta": ...}` frames ended
+    by a `{"done": true}` frame, and yields them as they arrive. A stream
+    that goes CHAT_STREAM_TIMEOUT seconds without a frame fails with
+    asyncio.TimeoutError.
+    """
+
+    def __init__(self, chat_url: str, connect_timeout: Optional[float] = None,
+                 multiplex: Optional[bool] = None, max_in_flight: Optional[int] = None,
+                 stream_timeout: Optional[float] = None, response_timeout: Optional[float] = None):
         self.chat_url = chat_url
+        self.connect_timeout = connect_timeout if connect_timeout is not None else float(
+            os.getenv("CHAT_CONNECT_TIMEOUT", "10"))
+        self.multiplex = multiplex if multiplex is not None else os.getenv(
+            "CHAT_WS_MULTIPLEX", "false").lower() in ("1", "true", "yes")
+        self.stream_timeout = stream_timeout if stream_timeout is not None else float(
+            os.getenv("CHAT_STREAM_TIMEOUT", "60"))
+        self.response_timeout = response_timeout if response_timeout is not None else float(
+            os.getenv("CHAT_RESPONSE_TIMEOUT", "60"))
+        max_in_flight = max_in_flight or int(os.getenv("CHAT_WS_MAX_IN_FLIGHT", "64"))
         self.websocket = None
         self.lock = asyncio.Lock()
+        self.in_flight_limit = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.reader: Optional[asyncio.Task] = None
 
     async def connect(self):
         try:
-            self.websocket = await websockets.connect(self.chat_url)
+            self.websocket = await asyncio.wait_for(websockets.connect(self.chat_url), self.connect_timeout)
             logger.info(f"Connected to chat WebSocket at {self.chat_url}")
         except Exception as e:
             logger.error(f"WebSocket connection failed: {e}")
             raise
+        if self.multiplex:
+            # requests in flight belong to the connection they were sent on
+            self.pending = {}
+            self.reader = asyncio.create_task(self.read_responses(self.websocket, self.pending))
+
+    async def read_responses(self, websocket, pending: Dict[str, Union[asyncio.Future, asyncio.Queue]]):
+        error = ConnectionError(f"Chat WebSocket {self.chat_url} closed")
+        try:
+            async for raw in websocket:
+                try:
+                    response = json.loads(raw)
+                except json.JSONDecodeError:
+                    logger.warning(f"Dropping non-JSON frame from {self.chat_url}")
+                    continue
+                correlation_id = response.pop("correlation_id", None) if isinstance(response, dict) else None
+                target = pending.get(correlation_id)
+                if target is None:
+                    # late frames of a request or stream that was abandoned
+                    logger.debug(f"Dropping response with unknown correlation_id {correlation_id} "
+                                 f"from {self.chat_url}")
+                    continue
+                if isinstance(target, asyncio.Queue):
+                    target.put_nowait(response)
+                elif not target.done():
+                    target.set_result(response)
+        except Exception as e:
+            logger.error(f"WebSocket error while reading from {self.chat_url}: {e}")
+            error = e
+        finally:
+            for target in pending.values():
+                if isinstance(target, asyncio.Queue):
+                    target.put_nowait(error)
+                elif not target.done():
+                    target.set_exception(error)
+
+    async def ensure_connected(self):
+        if self.websocket is None or self.websocket.closed:
+            async with self.lock:
+                if self.websocket is None or self.websocket.closed:
+                    await self.connect()
 
     async def push(self, message: dict) -> dict:
+        self.in_flight += 1
+        try:
+            if self.multiplex:
+                return await self.push_multiplexed(message)
+
+            async with self.lock:
+                if self.websocket is None or self.websocket.closed:
+                    await self.connect()
+
+                try:
+                    await self.websocket.send(json.dumps(message))
+                    response = await self.websocket.recv()
+                    return json.loads(response)
+                except Exception as e:
+                    logger.error(f"WebSocket error during push: {e}")
+                    raise
+        finally:
+            self.in_flight -= 1
+
+    async def push_multiplexed(self, message: dict) -> dict:
+        async with self.in_flight_limit:
+            await self.ensure_connected()
+            pending = self.pending
+            correlation_id = uuid.uuid4().hex
+            future = asyncio.get_running_loop().create_future()
+            pending[correlation_id] = future
+            try:
+                await self.websocket.send(json.dumps(dict(message, correlation_id=correlation_id)))
+                return await asyncio.wait_for(future, self.response_timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"No response from {self.chat_url} within {self.response_timeout}s")
+                raise
+            except Exception as e:
+                logger.error(f"WebSocket error during push: {e}")
+                raise
+            finally:
+                pending.pop(correlation_id, None)
+
+    async def stream(self, message: dict) -> AsyncIterator[dict]:
+        """
+        Yields the subject's `{"delta": ...}` frames, then the final response
+        with `"done": true`. Unless the subject's last frame carries its own
+        `response`, the final response is the concatenated deltas. A frame
+        with neither `delta` nor `done` is taken as the final response and,
+        if no delta came before it, passed through as the subject sent it.
+        """
+        self.in_flight += 1
+        frames = self.stream_multiplexed(message) if self.multiplex else self.stream_exclusive(message)
+        deltas = []
+        try:
+            async for frame in frames:
+                if final_frame(frame):
+                    final = dict(frame, done=True)
+                    if frame.get("done") or deltas:
+                        final.setdefault("response", "".join(deltas))
+                    yield final
+                    return
+                deltas.append(str(frame.get("delta", "")))
+                yield frame
+        finally:
+            await frames.aclose()
+            self.in_flight -= 1
+
+    async def stream_exclusive(self, message: dict) -> AsyncIterator[dict]:
         async with self.lock:
             if self.websocket is None or self.websocket.closed:
                 await self.connect()
 
+            done = False
             try:
-                await self.websocket.send(json.dumps(message))
-                response = await self.websocket.recv()
-                return json.loads(response)
+                await self.websocket.send(json.dumps(dict(message, stream=True)))
+                while not done:
+                    frame = stream_frame(await asyncio.wait_for(self.websocket.recv(), self.stream_timeout))
+                    done = final_frame(frame)
+                    yield frame
+            except asyncio.TimeoutError:
+                logger.error(f"No stream frame from {self.chat_url} within {self.stream_timeout}s")
+                raise
             except Exception as e:
-                logger.error(f"WebSocket error during push: {e}")
+                logger.error(f"WebSocket error during stream: {e}")
+                raise
+            finally:
+                if not done:
+                    # unread frames of this stream would be taken as the next response
+                    await self.websocket.close()
+
+    async def stream_multiplexed(self, message: dict) -> AsyncIterator[dict]:
+        async with self.in_flight_limit:
+            await self.ensure_connected()
+            pending = self.pending
+            correlation_id = uuid.uuid4().hex
+            frames = asyncio.Queue()
+            pending[correlation_id] = frames
+            try:
+                await self.websocket.send(json.dumps(dict(message, correlation_id=correlation_id, stream=True)))
+                while True:
+                    frame = await asyncio.wait_for(frames.get(), self.stream_timeout)
+                    if isinstance(frame, Exception):
+                        raise frame
+                    yield frame
+                    if final_frame(frame):
+                        return
+            except asyncio.TimeoutError:
+                logger.error(f"No stream frame from {self.chat_url} within {self.stream_timeout}s")
+                raise
+            except Exception as e:
+                logger.error(f"WebSocket error during stream: {e}")
                 raise
+            finally:
+                pending.pop(correlation_id, None)
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        if self.websocket is not None:
+            await self.websocket.close()
+
+
+class ChatWebSocketPool:
+    """CHAT_WS_POOL_SIZE connections to one subject; each push goes to the least busy one."""
+
+    def __init__(self, chat_url: str, size: int, connect_timeout: Optional[float] = None):
+        self.chat_url = chat_url
+        self.clients = [ChatWebSocketClient(chat_url, connect_timeout=connect_timeout) for _ in range(size)]
+
+    async def connect(self):
+        await asyncio.gather(*(client.connect() for client in self.clients))
+
+    async def push(self, message: dict) -> dict:
+        client = min(self.clients, key=lambda c: c.in_flight)
+        return await client.push(message)
+
+    def stream(self, message: dict) -> AsyncIterator[dict]:
+        client = min(self.clients, key=lambda c: c.in_flight)
+        return client.stream(message)
+
+    async def close(self):
+        await asyncio.gather(*(client.close() for client in self.clients), return_exceptions=True)
 
 
 class ChatProxyRouter:
-    def __init__(self, subjects_registry_url: str):
+    def __init__(self, subjects_registry_url: str, registry_timeout: Optional[float] = None,
+                 connect_timeout: Optional[float] = None):
         self.subjects_registry_url = subjects_registry_url.rstrip("/")
-        self.clients: Dict[str, ChatWebSocketClient] = {}
-        self.lock = asyncio.Lock()
+        self.registry_timeout = registry_timeout if registry_timeout is not None else float(
+            os.getenv("CHAT_REGISTRY_TIMEOUT", "5"))
+        self.connect_timeout = connect_timeout
+        self.registry_pool_size = int(os.getenv("CHAT_REGISTRY_POOL_SIZE", "100"))
+        self.ws_pool_size = int(os.getenv("CHAT_WS_POOL_SIZE", "1"))
+        self.clients: Dict[str, Union[ChatWebSocketClient, ChatWebSocketPool]] = {}
+        # one lock per subject being resolved, so concurrent first messages to
+        # the same subject share a single lookup while other subjects proceed
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.session: Optional[aiohttp.ClientSession] = None
 
-    async def get_client_for_subject(self, subject_id: str) -> ChatWebSocketClient:
-        async with self.lock:
+    def http_session(self) -> aiohttp.ClientSession:
+        # created lazily so the session is bound to the running event loop
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.registry_pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.registry_timeout)
+            )
+        return self.session
+
+    async def resolve_chat_url(self, subject_id: str) -> str:
+        async with self.http_session().get(
+            f"{self.subjects_registry_url}/subjects/get_subject_id",
+            params={"subject_id": subject_id}
+        ) as resp:
+            resp.raise_for_status()
+            data = await resp.json(content_type=None)
+        return data['data']['urlMap']['chatURL']
+
+    def create_client(self, chat_url: str) -> Union[ChatWebSocketClient, ChatWebSocketPool]:
+        if self.ws_pool_size > 1:
+            return ChatWebSocketPool(chat_url, self.ws_pool_size, connect_timeout=self.connect_timeout)
+        return ChatWebSocketClient(chat_url, connect_timeout=self.connect_timeout)
+
+    async def get_client_for_subject(self, subject_id: str) -> Union[ChatWebSocketClient, ChatWebSocketPool]:
+        client = self.clients.get(subject_id)
+        if client is not None:
+            return client
+
+        lock = self.locks.setdefault(subject_id, asyncio.Lock())
+        async with lock:
+            # another caller may have resolved the subject while we waited
             if subject_id in self.clients:
                 return self.clients[subject_id]
 
             try:
-                resp = requests.get(
-                    f"{self.subjects_registry_url}/subjects/get_subject_id",
-                    params={"subject_id": subject_id}
-                )
-                data = resp.json()
-                chat_url = data['data']['urlMap']['chatURL']
-                client = ChatWebSocketClient(chat_url)
+                chat_url = await self.resolve_chat_url(subject_id)
+                client = self.create_client(chat_url)
                 await client.connect()
                 self.clients[subject_id] = client
+                self.locks.pop(subject_id, None)
                 return client
             except Exception as e:
                 logger.error(f"Failed to get chatURL for subject {subject_id}: {e}")
@@ -65,4 +310,20 @@ class ChatProxyRouter:
 
     async def forward_message(self, subject_id: str, message: Dict) -> Dict:
         client = await self.get_client_for_subject(subject_id)
-        return await client.push(message)
\ No newline at end of file
+        return await client.push(message)
+
+    async def stream_message(self, subject_id: str, message: Dict) -> AsyncIterator[Dict]:
+        client = await self.get_client_for_subject(subject_id)
+        frames = client.stream(message)
+        try:
+            async for frame in frames:
+                yield frame
+        finally:
+            await frames.aclose()
+
+    async def close(self):
+        for client in list(self.clients.values()):
+            await client.close()
+        self.clients.clear()
+        if self.session is not None:
+            await self.session.close()
@@ -1,8 +1,12 @@
 import asyncio
+import os
+import signal
 import websockets
 import json
 import logging
-from .sessions import ChatMessagesDatabase
+from .chat import ChatManager
+from .proxy import ChatProxyRouter
+from .async_sessions import AsyncChatMessagesDatabase
 from .schema import ChatMessage
 
 logger = logging.getLogger(__name__)
@@ -10,7 +14,10 @@ logging.basicConfig(level=logging.INFO)
 
 # WebSocket clients
 clients = set()
-db = ChatMessagesDatabase()
+db = AsyncChatMessagesDatabase()
+chat_manager = ChatManager(
+    ChatProxyRouter(os.getenv("SUBJECTS_REGISTRY_URL", "http://localhost:8000")), db
+)
 
 
 async def handle_message(websocket, message):
@@ -20,19 +27,43 @@ async def handle_message(websocket, message):
 
         if action == "get_by_chat_id":
             chat_id = data.get("chat_id")
-            success, result = db.get_by_chat_id(chat_id)
+            success, result = await db.get_by_chat_id(chat_id)
             return {"success": success, "data": result.to_dict() if success else result}
 
         elif action == "query_by_session":
             session_id = data.get("session_id")
-            success, result = db.query_by_session(session_id)
+            success, result = await db.query_by_session(session_id)
             return {"success": success, "data": result}
 
         elif action == "insert":
             msg_obj = ChatMessage.from_dict(data)
-            success, result = db.insert(msg_obj)
+            success, result = await db.insert(msg_obj)
             return {"success": success, "data": {"chat_id": msg_obj.chat_id} if success else result}
 
+        elif action == "buffer_stats":
+            stats = db.stats()
+            return {"success": stats is not None, "data": stats if stats is not None else "Write-behind is disabled"}
+
+        elif action == "send_message":
+            response = await chat_manager.handle_message(
+                data.get("session_id"), data.get("subject_id"), data.get("message", {}), data.get("file_urls")
+            )
+            return {"success": True, "data": response}
+
+        elif action == "stream_message":
+            # deltas are pushed as they arrive; the final frame is the response
+            final = None
+            async for frame in chat_manager.stream_message(
+                data.get("session_id"), data.get("subject_id"), data.get("message", {}), data.get("file_urls")
+            ):
+                if frame.get("done"):
+                    final = {k: v for k, v in frame.items() if k != "done"}
+                else:
+                    await websocket.send(json.dumps({"success": True, "chunk": frame}))
+            if final is None:
+                return {"success": False, "error": "Stream ended without a final frame"}
+            return {"success": True, "done": True, "data": final}
+
         else:
             return {"success": False, "error": f"Unsupported action: {action}"}
 
@@ -61,7 +92,15 @@ async def handler(websocket, path):
 
 def run_ws_server(host='0.0.0.0', port=8765):
     logger.info(f"Starting WebSocket server on ws://{host}:{port}")
-    asyncio.get_event_loop().run_until_complete(websockets.serve(handler, host, port))
-    asyncio.get_event_loop().run_forever()
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(websockets.serve(handler, host, port))
+    # a stop signal ends run_forever, so the buffer is flushed below
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        # write out any buffered chat messages before exiting
+        loop.run_until_complete(db.close())
 
 
@@ -1,12 +1,18 @@
+import atexit
 import os
 import logging
-from typing import Tuple, Dict, Any
+import threading
+import time
+from typing import Tuple, Dict, Any, List
+from bson.errors import InvalidDocument
 from pymongo import MongoClient, errors
 from dataclasses import asdict
 from .schema import ChatSession, ChatMessage
 
 logger = logging.getLogger(__name__)
 
+DUPLICATE_KEY = 11000
+
 
 class ChatSessionDatabase:
     def __init__(self):
@@ -146,4 +152,199 @@ class ChatMessagesDatabase:
                 return False, "No document found to delete"
         except errors.PyMongoError as e:
             logger.error(f"Error deleting message: {e}")
-            return False, str(e)
\ No newline at end of file
+            return False, str(e)
+
+
+class WriteBehindChatMessagesDatabase(ChatMessagesDatabase):
+    """
+    ChatMessagesDatabase that acknowledges inserts from memory and writes them
+    with insert_many once CHAT_WRITE_BATCH_SIZE messages are buffered, and
+    otherwise every CHAT_WRITE_INTERVAL seconds. Buffered messages are
+    merged into reads, so a session's history includes them before they are
+    written. close() flushes what is left and also runs at interpreter exit.
+
+    Messages are written with `_id` set to their chat_id, so a failed batch
+    can be retried whole: copies written by an earlier attempt fail with a
+    duplicate key and count as written. Only a rejection of the document
+    itself (a write error other than a duplicate key, or a document that
+    cannot be encoded) moves a message to the `messages_dead` collection;
+    any other error keeps the batch buffered for the next flush. Once CHAT_WRITE_BUFFER_MAX messages
+    are pending, inserts bypass the buffer and are written synchronously.
+    """
+
+    def __init__(self, batch_size: int = None, interval: float = None, max_buffered: int = None):
+        super().__init__()
+        self.batch_size = batch_size or int(os.getenv("CHAT_WRITE_BATCH_SIZE", "100"))
+        self.interval = interval if interval is not None else float(os.getenv("CHAT_WRITE_INTERVAL", "1"))
+        self.max_buffered = max_buffered or int(os.getenv("CHAT_WRITE_BUFFER_MAX", "10000"))
+        self.dead_letters = self.db["messages_dead"]
+        self.buffer: List[ChatMessage] = []
+        self.buffered: Dict[str, ChatMessage] = {}
+        self.buffered_at: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.flushes = 0
+        self.written = 0
+        self.failures = 0
+        self.dead_lettered = 0
+        self.overflows = 0
+        self.thread = threading.Thread(target=self.run, name="chat-write-behind", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def insert(self, message: ChatMessage) -> Tuple[bool, Any]:
+        if self.stopped.is_set():
+            return super().insert(message)
+        with self.lock:
+            overflow = len(self.buffered) >= self.max_buffered
+            if overflow:
+                self.overflows += 1
+            else:
+                self.buffer.append(message)
+                self.buffered[message.chat_id] = message
+                self.buffered_at[message.chat_id] = time.monotonic()
+                full = len(self.buffer) >= self.batch_size
+        if overflow:
+            # MongoDB is falling behind or down: let callers feel it rather
+            # than growing the buffer without bound
+            return super().insert(message)
+        if full:
+            self.wake.set()
+        return True, message.chat_id
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """Writes everything buffered so far; returns the number of messages written."""
+        with self.flush_lock:
+            with self.lock:
+                batch, self.buffer = self.buffer, []
+            if not batch:
+                return 0
+
+            failed, dead = self._write(batch)
+            if failed:
+                logger.error(f"Failed to write {len(failed)} of {len(batch)} chat messages, will retry")
+            for message, reason in dead:
+                self._dead_letter(message, reason)
+            failed_ids = {m.chat_id for m in failed}
+
+            with self.lock:
+                # retried ahead of anything buffered since, to keep insertion
+                # order; messages deleted during the flush are not retried
+                failed = [m for m in failed if m.chat_id in self.buffered]
+                self.buffer = failed + self.buffer
+                for message in batch:
+                    if message.chat_id not in failed_ids:
+                        self.buffered.pop(message.chat_id, None)
+                        self.buffered_at.pop(message.chat_id, None)
+                self.flushes += 1 if len(batch) > len(failed) else 0
+                self.written += len(batch) - len(failed) - len(dead)
+                self.failures += 1 if failed else 0
+                self.dead_lettered += len(dead)
+            return len(batch) - len(failed) - len(dead)
+
+    def _write(self, batch: List[ChatMessage]) -> Tuple[List[ChatMessage], List[Tuple[ChatMessage, str]]]:
+        """Inserts a batch; returns the messages to retry and the (message, reason) pairs to dead-letter."""
+        try:
+            self.collection.insert_many([dict(m.to_dict(), _id=m.chat_id) for m in batch], ordered=False)
+            return [], []
+        except errors.BulkWriteError as e:
+            # unordered: everything but the reported documents was written
+            dead = [
+                (batch[error["index"]], error.get("errmsg", ""))
+                for error in e.details.get("writeErrors", [])
+                if error.get("code") != DUPLICATE_KEY
+            ]
+            return [], dead
+        except errors.PyMongoError as e:
+            # connection, auth, quota and the like fail every document alike
+            logger.error(f"Failed to write {len(batch)} chat messages: {e}")
+            return batch, []
+        except InvalidDocument as e:
+            if len(batch) == 1:
+                return [], [(batch[0], str(e))]
+            # rejected before reaching the server; find the offending messages
+            failed, dead = [], []
+            for message in batch:
+                message_failed, message_dead = self._write([message])
+                failed += message_failed
+                dead += message_dead
+            return failed, dead
+
+    def _dead_letter(self, message: ChatMessage, reason: str):
+        logger.error(f"Chat message {message.chat_id} was rejected and will not be retried: {reason}")
+        try:
+            self.dead_letters.insert_one({"chat_id": message.chat_id, "reason": reason, "message": repr(message)})
+        except errors.PyMongoError as e:
+            logger.error(f"Could not dead-letter chat message {message.chat_id}: {e}")
+
+    def query_by_session(self, session_id: str) -> Tuple[bool, Any]:
+        # taken before the query, so a message flushed meanwhile is found in
+        # one or the other
+        with self.lock:
+            pending = [m.to_dict() for m in self.buffered.values() if m.session_id == session_id]
+        success, messages = super().query_by_session(session_id)
+        if not success or not pending:
+            return success, messages
+
+        seen = {m.get("chat_id") for m in messages}
+        messages = messages + [m for m in pending if m["chat_id"] not in seen]
+        messages.sort(key=lambda m: m.get("timestamp", 0))
+        return True, messages
+
+    def get_by_chat_id(self, chat_id: str) -> Tuple[bool, Any]:
+        with self.lock:
+            message = self.buffered.get(chat_id)
+        if message is not None:
+            return True, message
+        return super().get_by_chat_id(chat_id)
+
+    def delete_by_chat_id(self, chat_id: str) -> Tuple[bool, Any]:
+        with self.lock:
+            message = self.buffered.pop(chat_id, None)
+            self.buffered_at.pop(chat_id, None)
+            if message is not None and any(m.chat_id == chat_id for m in self.buffer):
+                self.buffer = [m for m in self.buffer if m.chat_id != chat_id]
+                return True, 1
+        # not buffered, or already handed to an in-progress flush
+        self.flush()
+        return super().delete_by_chat_id(chat_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            oldest = min(self.buffered_at.values(), default=None)
+            return {
+                "buffered": len(self.buffered),
+                "oldest_buffered_age": time.monotonic() - oldest if oldest is not None else 0.0,
+                "flushes": self.flushes,
+                "written": self.written,
+                "failures": self.failures,
+                "dead_lettered": self.dead_lettered,
+                "overflows": self.overflows
+            }
+
+    def close(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+        with self.lock:
+            left = len(self.buffer)
+        if left:
+            logger.error(f"{left} chat messages could not be written before shutdown")
+
+
+def create_messages_database() -> ChatMessagesDatabase:
+    """The write-behind variant when CHAT_WRITE_BEHIND is set, the plain one otherwise."""
+    if os.getenv("CHAT_WRITE_BEHIND", "false").lower() in ("1", "true", "yes"):
+        return WriteBehindChatMessagesDatabase()
+    return ChatMessagesDatabase()
@@ -1,5 +1,6 @@
 import os
 import json
+import zlib
 import redis
 import logging
 import traceback
@@ -12,6 +13,7 @@ class MessageLogWriter(Thread):
         self.message_log_writer_queue = message_log_writer_queue
         self.redis_host = os.getenv("MESSAGE_LOG_WRITER_HOST")
         self.redis_port = os.getenv("MESSAGE_LOG_WRITER_PORT")
+        self.shards = int(os.getenv("MESSAGE_LOG_WRITER_SHARDS", 1))
         self.connection = None
         self.setup_redis_connection()
         self.daemon = True
@@ -24,13 +26,21 @@ class MessageLogWriter(Thread):
             logging.error(f"Error establishing Redis connection: {e}")
             logging.debug(traceback.format_exc())
 
+    def queue_for(self, message):
+        # shard 0 keeps the unsharded list name; must match the logger's REDIS_SHARDS
+        if self.shards <= 1:
+            return "MESSAGES"
+        key = str(message.get("message_uuid", "")).encode()
+        shard = zlib.crc32(key) % self.shards
+        return "MESSAGES" if shard == 0 else f"MESSAGES:{shard}"
+
     def run(self):
         try:
             while True:
                 message = self.message_log_writer_queue.get()
                 if message is not None:
                     message_json = json.dumps(message)
-                    self.connection.rpush("MESSAGES", message_json)
+                    self.connection.rpush(self.queue_for(message), message_json)
                     logging.info(f"Message written to Redis queue: {message_json}")
                 self.message_log_writer_queue.task_done()
         except Exception as e:
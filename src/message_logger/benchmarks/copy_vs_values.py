@@ -0,0 +1,79 @@
+"""
+Compare execute_values INSERTs against COPY FROM STDIN (text and binary).
+
+Run from the message_logger directory against a scratch database:
+
+    python -m benchmarks.copy_vs_values --sizes 100,1000,10000,50000
+"""
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from core.db import TimescaleDB
+
+BENCH_TABLE = 'message_exchange_bench'
+STRATEGIES = ('values', 'copy', 'copy_binary')
+
+
+def make_batch(size, payload_bytes):
+    now = datetime.now(timezone.utc)
+    payload = json.dumps({'text': 'x' * payload_bytes})
+    return [
+        (
+            str(uuid.uuid4()),
+            (now + timedelta(microseconds=i)).isoformat(),
+            (now + timedelta(microseconds=i, milliseconds=5)).isoformat(),
+            payload,
+            'subject-%d' % (i % 50),
+            ['subject-%d' % ((i + 1) % 50)],
+            'topic-%d' % (i % 10),
+            'event',
+            json.dumps({'seq': i})
+        )
+        for i in range(size)
+    ]
+
+
+def run(sizes, payload_bytes, repeat):
+    db = TimescaleDB(table_name=BENCH_TABLE)
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "CREATE TABLE IF NOT EXISTS {bench} (LIKE message_exchange INCLUDING ALL)".format(
+                    bench=BENCH_TABLE
+                )
+            )
+        conn.commit()
+
+    print('%-12s %8s %12s %12s' % ('strategy', 'batch', 'seconds', 'rows/sec'))
+    try:
+        for size in sizes:
+            for strategy in STRATEGIES:
+                elapsed = 0.0
+                for _ in range(repeat):
+                    batch = make_batch(size, payload_bytes)
+                    start = time.perf_counter()
+                    db.batch_insert(batch, strategy=strategy)
+                    elapsed += time.perf_counter() - start
+                elapsed /= repeat
+                print('%-12s %8d %12.4f %12.0f' % (strategy, size, elapsed, size / elapsed))
+    finally:
+        with db.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("DROP TABLE IF EXISTS {bench}".format(bench=BENCH_TABLE))
+            conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100,1000,5000,10000,50000')
+    parser.add_argument('--payload-bytes', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    run([int(s) for s in args.sizes.split(',')], args.payload_bytes, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
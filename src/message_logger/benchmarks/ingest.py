@@ -0,0 +1,231 @@
+"""
+Measure the sustained Redis -> Timescale ingestion rate of RedisConsumer.
+
+For every write strategy and batch size, a producer fills a scratch Redis
+list with synthetic envelopes (all at once, or at --rate messages/sec)
+while consumer workers drain it into message_exchange in a throwaway
+database, migrated like production so the hypertable and its search and
+conversation triggers are all on the write path. Reports rows/sec,
+end-to-end lag (enqueue to commit) and peak RSS growth.
+
+Run from the message_logger directory against a local Redis and a
+Postgres/Timescale server on which the configured user can create
+databases:
+
+    python -m benchmarks.ingest --messages 200000 --batch-sizes 100,1000,5000 --payload-bytes 512 --topics 50
+"""
+import argparse
+import json
+import os
+import resource
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import psycopg2
+import redis
+
+from core.config import Config
+from core.db import TimescaleDB
+from core.pool import DBPool
+from core.redis_consumer import RedisConsumer, heartbeat_key, processing_queue
+
+BENCH_TABLES = ('message_exchange', 'message_search', 'message_conversation')
+BENCH_QUEUE = 'MESSAGES:bench'
+STRATEGIES = ('values', 'copy', 'copy_binary')
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def make_envelope(i, payload, topics):
+    now = datetime.now(timezone.utc).isoformat()
+    return json.dumps({
+        'message_uuid': str(uuid.uuid4()),
+        'origin_ts': now,
+        'ack_ts': now,
+        'message_data': {'text': payload, 'seq': i},
+        'source_subject_id': 'subject-%d' % (i % 100),
+        'destination_subject_ids': ['subject-%d' % ((i + 1) % 100)],
+        'topic': 'topic-%d' % (i % topics),
+        'message_type': 'event',
+        'message_metadata': {'seq': i}
+    })
+
+
+def produce(redis_conn, messages, payload_bytes, topics, rate, chunk=1000):
+    payload = 'x' * payload_bytes
+    started = time.monotonic()
+    for offset in range(0, messages, chunk):
+        if rate:
+            # pace by chunk so the producer itself stays cheap
+            delay = started + offset / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        pipe = redis_conn.pipeline(transaction=False)
+        for i in range(offset, min(offset + chunk, messages)):
+            pipe.rpush(BENCH_QUEUE, make_envelope(i, payload, topics))
+        pipe.execute()
+
+
+class BenchConsumer(RedisConsumer):
+    """RedisConsumer that records, per committed message, the time since it was enqueued."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lags = []
+
+    def batch_write(self):
+        batch = self.messages
+        flushes = self.flushes
+        super().batch_write()
+        if self.flushes > flushes:
+            now = time.time()
+            self.lags.extend(now - datetime.fromisoformat(m[1]).timestamp() for m in batch)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def cleanup(redis_conn, consumers):
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.delete(BENCH_QUEUE)
+    for consumer in consumers:
+        pipe.delete(processing_queue(consumer.worker_id))
+        pipe.delete(heartbeat_key(consumer.worker_id))
+        pipe.hdel(Config.CONSUMER_STATS_KEY, consumer.worker_id)
+    pipe.execute()
+
+
+def run_once(redis_conn, db_pool, strategy, batch_size, args):
+    Config.WRITE_STRATEGY = strategy
+    Config.BATCH_SIZE = batch_size
+    Config.BATCH_INTERVAL = args.batch_interval
+    consumers = [
+        BenchConsumer(
+            worker_id='bench-{}'.format(i),
+            queues=[BENCH_QUEUE],
+            db=TimescaleDB(pool=db_pool)
+        )
+        for i in range(args.workers)
+    ]
+    cleanup(redis_conn, consumers)
+    with db_pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("TRUNCATE {}".format(', '.join(BENCH_TABLES)))
+        conn.commit()
+
+    producer = threading.Thread(
+        target=produce, args=(redis_conn, args.messages, args.payload_bytes, args.topics, args.rate)
+    )
+    if not args.rate:
+        # a pre-filled backlog measures the drain rate alone
+        producer.run()
+    baseline_rss = peak_rss = rss_bytes()
+    started = time.perf_counter()
+    if args.rate:
+        producer.start()
+    threads = [threading.Thread(target=c.listen_to_redis) for c in consumers]
+    for thread in threads:
+        thread.start()
+
+    timed_out = False
+    while sum(c.written + c.rejected for c in consumers) < args.messages:
+        if time.perf_counter() - started > args.timeout:
+            # failing writes would otherwise keep the run going forever
+            timed_out = True
+            break
+        peak_rss = max(peak_rss, rss_bytes())
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    for consumer in consumers:
+        consumer.stop()
+    for thread in threads + ([producer] if args.rate else []):
+        thread.join()
+    cleanup(redis_conn, consumers)
+
+    if timed_out:
+        print('%-12s %7d timed out after %ds with %d of %d rows written (%d failed flushes)' % (
+            strategy, batch_size, args.timeout, sum(c.written for c in consumers), args.messages,
+            sum(c.failures for c in consumers)
+        ))
+        return
+    lags = [lag for c in consumers for lag in c.lags]
+    print('%-12s %7d %10.0f %10.1f %10.1f %10.1f %10.1f' % (
+        strategy, batch_size, args.messages / elapsed,
+        percentile(lags, 0.5) * 1000, percentile(lags, 0.99) * 1000, max(lags, default=0.0) * 1000,
+        (peak_rss - baseline_rss) / (1024 * 1024)
+    ))
+
+
+def admin_execute(statement):
+    # CREATE/DROP DATABASE cannot run in a transaction, so not via the pool
+    conn = psycopg2.connect(
+        host=Config.DB_HOST, port=Config.DB_PORT, user=Config.DB_USER,
+        password=Config.DB_PASSWORD, dbname=Config.DB_NAME
+    )
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(statement)
+    finally:
+        conn.close()
+
+
+def run(args):
+    if args.database == Config.DB_NAME:
+        raise SystemExit("--database must name a throwaway database, not DB_NAME")
+    redis_conn = redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, decode_responses=True)
+    admin_execute('DROP DATABASE IF EXISTS "{}"'.format(args.database))
+    admin_execute('CREATE DATABASE "{}"'.format(args.database))
+    admin_db, Config.DB_NAME = Config.DB_NAME, args.database
+    db_pool = DBPool(minconn=args.workers, maxconn=args.workers + 1)
+    # runs the schema migrations, exactly as the writer does on startup
+    TimescaleDB(pool=db_pool)
+
+    print('%-12s %7s %10s %10s %10s %10s %10s' % (
+        'strategy', 'batch', 'rows/sec', 'lag p50', 'lag p99', 'lag max', 'rss MiB'
+    ))
+    try:
+        for batch_size in args.batch_sizes:
+            for strategy in args.strategies:
+                run_once(redis_conn, db_pool, strategy, batch_size, args)
+    finally:
+        db_pool.close()
+        Config.DB_NAME = admin_db
+        admin_execute('DROP DATABASE IF EXISTS "{}"'.format(args.database))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--payload-bytes', type=int, default=256)
+    parser.add_argument('--topics', type=int, default=10, help="topic cardinality")
+    parser.add_argument('--rate', type=float, default=0, help="producer messages/sec, 0 to fill the queue up front")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--strategies', default=','.join(STRATEGIES))
+    parser.add_argument('--batch-sizes', default='100,1000,5000')
+    parser.add_argument('--batch-interval', type=float, default=1, help="seconds before a partial batch is flushed")
+    parser.add_argument('--database', default='message_logger_bench',
+                        help="throwaway database, created and dropped by the run")
+    parser.add_argument('--timeout', type=float, default=600, help="seconds allowed per strategy and batch size")
+    args = parser.parse_args()
+    args.strategies = args.strategies.split(',')
+    args.batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Concurrent-read load test for the Flask and ASGI read APIs.
+
+Start both servers against the same database, e.g.
+
+    python -m core.api_server          # Flask, port 5000
+    python -m core.async_api_server    # ASGI, port 8000
+
+then run from the message_logger directory:
+
+    python -m benchmarks.read_api_load --subject subject-1 --concurrency 1,8,32,128
+
+Each target is hit with the same mix of subject pages and searches at
+every concurrency level, and throughput and latency percentiles are
+reported side by side.
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+TARGETS = {
+    'flask': 'http://localhost:5000',
+    'asgi': 'http://localhost:8000',
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def request_paths(subject, topic):
+    paths = ['/messages/subject/{}?limit=100'.format(subject)]
+    if topic:
+        paths.append('/messages/search?topic={}&limit=100'.format(topic))
+    return paths
+
+
+async def run_level(base_url, paths, concurrency, requests):
+    latencies = []
+    errors = 0
+    next_request = 0
+
+    async def worker(session):
+        nonlocal next_request, errors
+        while next_request < requests:
+            path = paths[next_request % len(paths)]
+            next_request += 1
+            start = time.perf_counter()
+            try:
+                async with session.get(base_url + path) as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return len(latencies) / elapsed, percentile(latencies, 0.5), percentile(latencies, 0.99), errors
+
+
+async def run(targets, paths, levels, requests):
+    print('%-8s %6s %10s %10s %10s %8s' % ('target', 'conc', 'req/sec', 'p50 ms', 'p99 ms', 'errors'))
+    for concurrency in levels:
+        for name, base_url in targets.items():
+            rate, p50, p99, errors = await run_level(base_url, paths, concurrency, requests)
+            print('%-8s %6d %10.0f %10.1f %10.1f %8d' % (name, concurrency, rate, p50 * 1000, p99 * 1000, errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subject', required=True)
+    parser.add_argument('--topic')
+    parser.add_argument('--concurrency', default='1,8,32,128')
+    parser.add_argument('--requests', type=int, default=2000, help="requests per target and level")
+    parser.add_argument('--flask-url', default=TARGETS['flask'])
+    parser.add_argument('--asgi-url', default=TARGETS['asgi'])
+    args = parser.parse_args()
+
+    targets = {'flask': args.flask_url, 'asgi': args.asgi_url}
+    asyncio.run(run(
+        targets,
+        request_paths(args.subject, args.topic),
+        [int(c) for c in args.concurrency.split(',')],
+        args.requests
+    ))
+
+
+if __name__ == '__main__':
+    main()
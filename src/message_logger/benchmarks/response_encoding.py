@@ -0,0 +1,70 @@
+"""
+Compare response size and serialisation time of read-API pages for full
+rows against header-only projections, across the negotiable encodings.
+
+Needs no database; run from the message_logger directory:
+
+    python -m benchmarks.response_encoding --rows 1000 --payload-bytes 2048
+"""
+import argparse
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from core.encoding import encode_response, msgpack, zstandard
+from core.queries import parse_fields, project
+
+ENCODINGS = (
+    ('json', None, None),
+    ('json+gzip', None, 'gzip'),
+    ('json+zstd', None, 'zstd'),
+    ('msgpack', 'application/msgpack', None),
+    ('msgpack+zstd', 'application/msgpack', 'zstd'),
+)
+
+
+def make_page(rows, payload_bytes):
+    now = datetime.now(timezone.utc)
+    return [
+        {
+            'message_uuid': str(uuid.uuid4()),
+            'origin_ts': (now + timedelta(microseconds=i)).isoformat(),
+            'ack_ts': (now + timedelta(microseconds=i, milliseconds=5)).isoformat(),
+            'message_data': {'text': 'lorem ipsum ' * (payload_bytes // 12), 'seq': i},
+            'source_subject_id': 'subject-%d' % (i % 50),
+            'destination_subject_ids': ['subject-%d' % ((i + 1) % 50)],
+            'topic': 'topic-%d' % (i % 10),
+            'message_type': 'event',
+            'message_metadata': {'seq': i},
+        }
+        for i in range(rows)
+    ]
+
+
+def run(rows, payload_bytes, repeat):
+    page = make_page(rows, payload_bytes)
+    variants = (('full', page), ('headers', [project(m, parse_fields('headers')) for m in page]))
+
+    print('%-8s %-14s %12s %12s' % ('rows', 'encoding', 'bytes', 'ms'))
+    for name, content in variants:
+        for label, accept, accept_encoding in ENCODINGS:
+            if (accept and msgpack is None) or (accept_encoding == 'zstd' and zstandard is None):
+                continue
+            start = time.perf_counter()
+            for _ in range(repeat):
+                body, _ = encode_response(content, accept, accept_encoding)
+            elapsed = (time.perf_counter() - start) / repeat
+            print('%-8s %-14s %12d %12.2f' % (name, label, len(body), elapsed * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--payload-bytes', type=int, default=2048)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    run(args.rows, args.payload_bytes, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,190 @@
-from flask import Flask, jsonify, request
+import json
+
+import redis
+from flask import Flask, Response, jsonify, request
 from .read_controller import ReadController
+from .queries import InvalidQuery, SEARCH_FILTERS, STATS_FILTERS, parse_fields, project
+from .encoding import encode_response
+from .pool import PoolTimeout
+from .redis_consumer import consumer_lag
+from .export import ExportManager
+from .replay import ReplayManager
+from .metrics import MetricsSampler
+from .sampling import InvalidPolicy, load_policies, set_policy, delete_policy
+from .config import Config
 
 app = Flask(__name__)
 read_controller = ReadController()
+export_manager = ExportManager(read_controller.db)
+replay_manager = ReplayManager(read_controller.db)
+redis_conn = redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, decode_responses=True)
+metrics_sampler = MetricsSampler(redis_conn).start()
+
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(e):
+    return jsonify({'error': str(e)}), 503
+
+@app.errorhandler(InvalidQuery)
+def handle_invalid_query(e):
+    return jsonify({'error': str(e)}), 400
+
+def ndjson_response(messages):
+    def generate():
+        for message in messages:
+            yield json.dumps(message) + '\n'
+    return Response(generate(), mimetype='application/x-ndjson')
+
+def encoded_response(content):
+    body, headers = encode_response(
+        content, request.headers.get('Accept'), request.headers.get('Accept-Encoding')
+    )
+    return Response(body, headers=headers)
+
+def paged_response(messages, next_cursor):
+    response = encoded_response(messages)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 @app.route('/messages/<message_uuid>', methods=['GET'])
 def get_message(message_uuid):
+    fields = parse_fields(request.args.get('fields'))
     message = read_controller.get_message_by_uuid(message_uuid)
     if message:
-        return jsonify(message)
+        return encoded_response(project(message, fields))
     return jsonify({'error': 'Message not found'}), 404
 
+@app.route('/messages/search', methods=['GET'])
+def search_messages():
+    filters = {name: request.args[name] for name in SEARCH_FILTERS if name in request.args}
+    messages, next_cursor = read_controller.search_messages(
+        filters,
+        limit=request.args.get('limit', type=int),
+        cursor=request.args.get('cursor'),
+        sort=request.args.get('sort', 'time'),
+        fields=parse_fields(request.args.get('fields'))
+    )
+    return paged_response(messages, next_cursor)
+
+@app.route('/messages/conversation', methods=['GET'])
+def get_conversation():
+    messages, next_cursor = read_controller.get_conversation(
+        request.args.get('a'),
+        request.args.get('b'),
+        limit=request.args.get('limit', type=int),
+        cursor=request.args.get('cursor'),
+        fields=parse_fields(request.args.get('fields')),
+        start=request.args.get('start'),
+        end=request.args.get('end')
+    )
+    return paged_response(messages, next_cursor)
+
 @app.route('/messages/subject/<subject_id>', methods=['GET'])
 def get_messages_by_subject(subject_id):
-    messages = read_controller.get_messages_by_subject(subject_id)
-    return jsonify(messages)
+    cursor = request.args.get('cursor')
+    fields = parse_fields(request.args.get('fields'))
+    if request.args.get('format') == 'ndjson':
+        return ndjson_response(read_controller.stream_messages_by_subject(subject_id, cursor, fields))
+
+    messages, next_cursor = read_controller.get_messages_by_subject(
+        subject_id, limit=request.args.get('limit', type=int), cursor=cursor, fields=fields
+    )
+    return paged_response(messages, next_cursor)
+
+@app.route('/exports', methods=['POST'])
+def start_export():
+    body = request.json or {}
+    try:
+        manifest = export_manager.start(body.get('filters', {}), fmt=body.get('format', 'parquet'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(manifest), 202
+
+@app.route('/exports/<job_id>', methods=['GET'])
+def get_export(job_id):
+    manifest = export_manager.status(job_id)
+    if manifest:
+        return jsonify(manifest)
+    return jsonify({'error': 'Export not found'}), 404
+
+@app.route('/exports/<job_id>/resume', methods=['POST'])
+def resume_export(job_id):
+    manifest = export_manager.resume(job_id)
+    if manifest:
+        return jsonify(manifest), 202
+    return jsonify({'error': 'Export not found'}), 404
+
+@app.route('/replays', methods=['POST'])
+def start_replay():
+    body = request.json or {}
+    try:
+        state = replay_manager.start(
+            body.get('filters', {}),
+            target=body.get('target', 'nats'),
+            rate=body.get('rate'),
+            concurrency=body.get('concurrency'),
+            dry_run=bool(body.get('dry_run', False))
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(state), 202
+
+@app.route('/replays/<job_id>', methods=['GET'])
+def get_replay(job_id):
+    state = replay_manager.status(job_id)
+    if state:
+        return jsonify(state)
+    return jsonify({'error': 'Replay not found'}), 404
+
+@app.route('/replays/<job_id>/resume', methods=['POST'])
+def resume_replay(job_id):
+    state = replay_manager.resume(job_id)
+    if state:
+        return jsonify(state), 202
+    return jsonify({'error': 'Replay not found'}), 404
+
+@app.route('/sampling', methods=['GET'])
+def get_sampling_policies():
+    return jsonify(load_policies(redis_conn))
+
+@app.route('/sampling/<topic>', methods=['PUT'])
+def put_sampling_policy(topic):
+    try:
+        policy = set_policy(redis_conn, topic, request.json or {})
+    except InvalidPolicy as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(policy)
+
+@app.route('/sampling/<topic>', methods=['DELETE'])
+def delete_sampling_policy(topic):
+    if delete_policy(redis_conn, topic):
+        return '', 204
+    return jsonify({'error': 'Policy not found'}), 404
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    filters = {name: request.args[name] for name in STATS_FILTERS if name in request.args}
+    return jsonify(read_controller.get_stats(
+        bucket=request.args.get('bucket', '1h'),
+        filters=filters,
+        limit=request.args.get('limit', type=int)
+    ))
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics_sampler.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/pool', methods=['GET'])
+def get_pool_stats():
+    return jsonify(read_controller.pool_stats())
+
+@app.route('/metrics/cache', methods=['GET'])
+def get_cache_stats():
+    return jsonify(read_controller.cache_stats())
+
+@app.route('/metrics/consumers', methods=['GET'])
+def get_consumer_lag():
+    return jsonify(consumer_lag(redis_conn))
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0')
+    app.run(debug=True, host='0.0.0.0', threaded=True)
@@ -0,0 +1,300 @@
+import io
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from .config import Config
+from .db import TimescaleDB
+from .export import write_parquet, pq
+
+logger = logging.getLogger(__name__)
+
+
+class LocalObjectStore:
+    def __init__(self, root=None):
+        self.root = root or Config.ARCHIVE_LOCAL_PATH
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(os.path.abspath(self.root) + os.sep):
+            raise ValueError("Invalid object key: {}".format(key))
+        return path
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+
+class S3ObjectStore:
+    def __init__(self, bucket=None):
+        import boto3
+
+        self.bucket = bucket or os.getenv("S3_BUCKET")
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=os.getenv("S3_URL"),
+            aws_access_key_id=os.getenv("S3_ACCESS_KEY"),
+            aws_secret_access_key=os.getenv("S3_SECRET_KEY"),
+            region_name=os.getenv("S3_REGION", "us-east-1")
+        )
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+
+def get_object_store():
+    if Config.ARCHIVE_STORE == 's3':
+        return S3ObjectStore()
+    return LocalObjectStore()
+
+
+def _to_utc(value):
+    ts = value if isinstance(value, datetime) else datetime.fromisoformat(value)
+    return ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts
+
+
+def archived_row_to_dict(row):
+    message = dict(row)
+    for column in ('origin_ts', 'ack_ts'):
+        if message[column] is not None:
+            message[column] = message[column].isoformat()
+    for column in ('message_data', 'message_metadata'):
+        if message[column] is not None:
+            message[column] = json.loads(message[column])
+    return message
+
+
+class MessageArchive:
+    """
+    Cold tier for message_exchange. Chunks older than ARCHIVE_AFTER are
+    written to the object store as Parquet objects, recorded in
+    message_archive_manifest (time range per object) and
+    message_archive_index (object per message UUID), and then dropped from
+    the hypertable. The read path uses the same tables to fall back to the
+    archive transparently.
+    """
+
+    def __init__(self, db=None, store=None):
+        if pq is None:
+            raise RuntimeError("Message archival requires pyarrow")
+        self.db = db or TimescaleDB()
+        self.store = store or get_object_store()
+        self.watermark_value = None
+        self.watermark_checked_at = 0.0
+
+    def archivable_chunks(self, cur):
+        cur.execute(
+            """
+            SELECT chunk_schema, chunk_name, range_start, range_end
+            FROM timescaledb_information.chunks
+            WHERE hypertable_name = 'message_exchange'
+              AND range_end < now() - %s::interval
+            ORDER BY range_start
+            """,
+            (Config.ARCHIVE_AFTER,)
+        )
+        return cur.fetchall()
+
+    def archive_chunk(self, conn, chunk_schema, chunk_name, range_start, range_end):
+        """
+        Copies one chunk into ARCHIVE_ROWS_PER_OBJECT-row Parquet objects and
+        drops it. The manifest and index rows commit in the same transaction
+        as the drop, so a crash at any point leaves every row readable from
+        at least one tier; re-running simply overwrites the objects.
+        """
+        archived = 0
+        chunk = '{}.{}'.format(
+            psycopg2.extensions.quote_ident(chunk_schema, conn),
+            psycopg2.extensions.quote_ident(chunk_name, conn)
+        )
+        with conn.cursor(name='archive_{}'.format(uuid.uuid4().hex)) as reader, conn.cursor() as cur:
+            reader.itersize = Config.ARCHIVE_ROWS_PER_OBJECT
+            reader.execute("SELECT * FROM {} ORDER BY origin_ts, message_uuid".format(chunk))
+            part = 0
+            while True:
+                rows = reader.fetchmany(Config.ARCHIVE_ROWS_PER_OBJECT)
+                if not rows:
+                    break
+                columns = [d.name for d in reader.description]
+                ts_index = columns.index('origin_ts')
+                uuid_index = columns.index('message_uuid')
+                key = 'message_exchange/{}/part-{:05d}.parquet'.format(chunk_name, part)
+
+                buf = io.BytesIO()
+                write_parquet(buf, columns, rows)
+                self.store.put(key, buf.getvalue())
+
+                cur.execute(
+                    """
+                    INSERT INTO message_archive_manifest
+                        (object_key, chunk_name, range_start, range_end, row_count)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (object_key) DO UPDATE SET
+                        range_start = EXCLUDED.range_start,
+                        range_end = EXCLUDED.range_end,
+                        row_count = EXCLUDED.row_count
+                    """,
+                    (key, chunk_name, rows[0][ts_index], rows[-1][ts_index], len(rows))
+                )
+                execute_values(
+                    cur,
+                    "INSERT INTO message_archive_index (message_uuid, origin_ts, object_key) "
+                    "VALUES %s ON CONFLICT DO NOTHING",
+                    [(str(row[uuid_index]), row[ts_index], key) for row in rows]
+                )
+                archived += len(rows)
+                part += 1
+
+            # the side tables share the chunk interval, so the same bounds
+            # drop the search vectors and conversation entries of the archived rows
+            for table in ('message_exchange', 'message_search', 'message_conversation'):
+                cur.execute(
+                    "SELECT drop_chunks(%s, older_than => %s, newer_than => %s)",
+                    (table, range_end, range_start)
+                )
+        conn.commit()
+        return archived
+
+    def run(self):
+        """Archives every chunk past ARCHIVE_AFTER; returns the number of rows moved."""
+        archived = 0
+        if not Config.ARCHIVE_AFTER:
+            return archived
+        with self.db.connection() as conn:
+            with conn.cursor() as cur:
+                chunks = self.archivable_chunks(cur)
+            conn.commit()
+            for chunk_schema, chunk_name, range_start, range_end in chunks:
+                rows = self.archive_chunk(conn, chunk_schema, chunk_name, range_start, range_end)
+                logger.info(f"Archived {rows} rows from chunk {chunk_name}")
+                archived += rows
+        return archived
+
+    def watermark(self):
+        """Newest origin_ts held in the archive, or None if nothing is archived."""
+        # archival runs rarely, so the read path re-checks at most once per TTL
+        if time.monotonic() - self.watermark_checked_at < Config.ARCHIVE_WATERMARK_TTL:
+            return self.watermark_value
+        with self.db.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT max(range_end) FROM message_archive_manifest")
+                self.watermark_value = cur.fetchone()[0]
+        self.watermark_checked_at = time.monotonic()
+        return self.watermark_value
+
+    def _read(self, key, filters):
+        table = pq.read_table(io.BytesIO(self.store.get(key)), filters=filters or None)
+        return table.to_pylist()
+
+    def _last_key(self, data, range_end):
+        """Keyset position of the last row of an object whose newest origin_ts is range_end."""
+        rows = pq.read_table(
+            io.BytesIO(data), columns=['origin_ts', 'message_uuid'], filters=[('origin_ts', '==', range_end)]
+        ).to_pylist()
+        origin_ts, message_uuid = max((r['origin_ts'], str(r['message_uuid'])) for r in rows)
+        return origin_ts.isoformat(), message_uuid
+
+    def get_message(self, message_uuid):
+        with self.db.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT object_key FROM message_archive_index WHERE message_uuid = %s",
+                    (message_uuid,)
+                )
+                row = cur.fetchone()
+        if row is None:
+            return None
+        rows = self._read(row[0], [('message_uuid', '==', str(uuid.UUID(str(message_uuid))))])
+        return archived_row_to_dict(rows[0]) if rows else None
+
+    def search(self, filters, after=None, limit=None, max_objects=None):
+        """
+        Returns archived messages matching the /messages/search filters in
+        (origin_ts, message_uuid) order, strictly after the `after` keyset
+        position, reading one object at a time and stopping at `limit` rows,
+        plus the keyset position to resume from. The position is None unless
+        the scan stopped after `max_objects` objects (ARCHIVE_SEARCH_MAX_OBJECTS)
+        with the archive not yet exhausted.
+        """
+        max_objects = max_objects or Config.ARCHIVE_SEARCH_MAX_OBJECTS
+        start = _to_utc(filters['start']) if filters.get('start') else None
+        end = _to_utc(filters['end']) if filters.get('end') else None
+
+        query = "SELECT object_key, range_end FROM message_archive_manifest WHERE true"
+        params = []
+        if start is not None:
+            query += " AND range_end >= %s"
+            params.append(start)
+        if end is not None:
+            query += " AND range_start < %s"
+            params.append(end)
+        if after is not None:
+            query += " AND range_end >= %s::timestamptz"
+            params.append(after[0])
+        query += " ORDER BY range_start"
+
+        with self.db.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                objects = cur.fetchall()
+
+        pushdown = []
+        for name, column in (('topic', 'topic'), ('message_type', 'message_type'), ('source', 'source_subject_id')):
+            if filters.get(name) is not None:
+                pushdown.append((column, '==', filters[name]))
+        if start is not None:
+            pushdown.append(('origin_ts', '>=', start))
+        if end is not None:
+            pushdown.append(('origin_ts', '<', end))
+
+        after_key = (_to_utc(after[0]), str(after[1])) if after is not None else None
+        destination = filters.get('destination')
+
+        messages = []
+        scanned, previous = 0, None
+        for key, range_end in objects:
+            if scanned == max_objects:
+                return messages, self._last_key(*previous)
+            data = self.store.get(key)
+            # an object ending exactly at the cursor was usually finished by the
+            # previous page, so only objects reaching past it count toward the cap
+            if after_key is None or _to_utc(range_end) > after_key[0]:
+                scanned, previous = scanned + 1, (data, range_end)
+            rows = pq.read_table(io.BytesIO(data), filters=pushdown or None).to_pylist()
+            rows.sort(key=lambda r: (r['origin_ts'], r['message_uuid']))
+            for row in rows:
+                if after_key is not None and (row['origin_ts'], row['message_uuid']) <= after_key:
+                    continue
+                if destination is not None and destination not in (row['destination_subject_ids'] or []):
+                    continue
+                messages.append(archived_row_to_dict(row))
+                if limit is not None and len(messages) >= limit:
+                    return messages, None
+        return messages, None
+
+
+def run_archiver():
+    archived = MessageArchive().run()
+    logger.info(f"Archival run complete, {archived} rows archived")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run_archiver()
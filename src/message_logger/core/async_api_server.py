@@ -0,0 +1,312 @@
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+
+import redis
+from psycopg_pool import PoolTimeout as AsyncPoolTimeout
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from .async_read_controller import AsyncReadController
+from .db import TimescaleDB
+from .queries import InvalidQuery, SEARCH_FILTERS, STATS_FILTERS, parse_fields, project
+from .encoding import encode_response
+from .pool import PoolTimeout
+from .redis_consumer import consumer_lag
+from .export import ExportManager
+from .replay import ReplayManager
+from .metrics import MetricsSampler
+from .sampling import InvalidPolicy, load_policies, set_policy, delete_policy
+from .config import Config
+
+logger = logging.getLogger(__name__)
+
+read_controller = AsyncReadController()
+redis_conn = redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, decode_responses=True)
+metrics_sampler = MetricsSampler(redis_conn)
+# export and replay jobs run on their own threads against the blocking pool
+jobs_db = TimescaleDB()
+export_manager = ExportManager(jobs_db)
+replay_manager = ReplayManager(jobs_db)
+
+
+def json_response(content, status_code=200, headers=None):
+    return Response(json.dumps(content, default=str), status_code=status_code, headers=headers,
+                    media_type='application/json')
+
+
+def encoded_response(request, content):
+    body, headers = encode_response(
+        content, request.headers.get('accept'), request.headers.get('accept-encoding')
+    )
+    return Response(body, headers=headers)
+
+
+def paged_response(request, messages, next_cursor):
+    response = encoded_response(request, messages)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+
+def int_arg(request, name):
+    try:
+        return int(request.query_params[name]) if name in request.query_params else None
+    except ValueError:
+        return None
+
+
+async def request_body(request):
+    try:
+        return await request.json() or {}
+    except ValueError:
+        return {}
+
+
+async def watch_disconnect(request):
+    while not await request.is_disconnected():
+        await asyncio.sleep(Config.ASYNC_DISCONNECT_POLL)
+
+
+def with_deadline(handler):
+    """
+    Runs a handler under ASYNC_REQUEST_TIMEOUT and cancels it, together with
+    any query it is waiting on, on timeout or when the client goes away.
+    """
+    async def wrapped(request):
+        task = asyncio.ensure_future(handler(request))
+        watcher = asyncio.ensure_future(watch_disconnect(request))
+        try:
+            done, _ = await asyncio.wait(
+                {task, watcher}, timeout=Config.ASYNC_REQUEST_TIMEOUT, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            watcher.cancel()
+
+        if task in done:
+            return task.result()
+        task.cancel()
+        if watcher in done:
+            logger.info(f"Client disconnected, cancelled {request.method} {request.url.path}")
+            return Response(status_code=499)
+        return json_response({'error': 'Request timed out'}, status_code=504)
+    return wrapped
+
+
+@with_deadline
+async def get_message(request):
+    fields = parse_fields(request.query_params.get('fields'))
+    message = await read_controller.get_message_by_uuid(request.path_params['message_uuid'])
+    if message:
+        return encoded_response(request, project(message, fields))
+    return json_response({'error': 'Message not found'}, status_code=404)
+
+
+@with_deadline
+async def search_messages(request):
+    args = request.query_params
+    filters = {name: args[name] for name in SEARCH_FILTERS if name in args}
+    messages, next_cursor = await read_controller.search_messages(
+        filters,
+        limit=int_arg(request, 'limit'),
+        cursor=args.get('cursor'),
+        sort=args.get('sort', 'time'),
+        fields=parse_fields(args.get('fields'))
+    )
+    return paged_response(request, messages, next_cursor)
+
+
+@with_deadline
+async def get_conversation(request):
+    args = request.query_params
+    messages, next_cursor = await read_controller.get_conversation(
+        args.get('a'),
+        args.get('b'),
+        limit=int_arg(request, 'limit'),
+        cursor=args.get('cursor'),
+        fields=parse_fields(args.get('fields')),
+        start=args.get('start'),
+        end=args.get('end')
+    )
+    return paged_response(request, messages, next_cursor)
+
+
+@with_deadline
+async def get_subject_page(request):
+    messages, next_cursor = await read_controller.get_messages_by_subject(
+        request.path_params['subject_id'],
+        limit=int_arg(request, 'limit'),
+        cursor=request.query_params.get('cursor'),
+        fields=parse_fields(request.query_params.get('fields'))
+    )
+    return paged_response(request, messages, next_cursor)
+
+
+async def get_messages_by_subject(request):
+    if request.query_params.get('format') != 'ndjson':
+        return await get_subject_page(request)
+
+    # streams are unbounded, so they get no deadline; Starlette stops the
+    # generator, closing the server-side cursor, when the client disconnects
+    subject_id = request.path_params['subject_id']
+    cursor = request.query_params.get('cursor')
+    fields = parse_fields(request.query_params.get('fields'))
+
+    async def generate():
+        async for message in read_controller.stream_messages_by_subject(subject_id, cursor, fields):
+            yield json.dumps(message, default=str) + '\n'
+    return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+
+async def start_export(request):
+    body = await request_body(request)
+    try:
+        manifest = export_manager.start(body.get('filters', {}), fmt=body.get('format', 'parquet'))
+    except ValueError as e:
+        return json_response({'error': str(e)}, status_code=400)
+    return json_response(manifest, status_code=202)
+
+
+async def get_export(request):
+    manifest = export_manager.status(request.path_params['job_id'])
+    if manifest:
+        return json_response(manifest)
+    return json_response({'error': 'Export not found'}, status_code=404)
+
+
+async def resume_export(request):
+    manifest = export_manager.resume(request.path_params['job_id'])
+    if manifest:
+        return json_response(manifest, status_code=202)
+    return json_response({'error': 'Export not found'}, status_code=404)
+
+
+async def start_replay(request):
+    body = await request_body(request)
+    try:
+        state = replay_manager.start(
+            body.get('filters', {}),
+            target=body.get('target', 'nats'),
+            rate=body.get('rate'),
+            concurrency=body.get('concurrency'),
+            dry_run=bool(body.get('dry_run', False))
+        )
+    except ValueError as e:
+        return json_response({'error': str(e)}, status_code=400)
+    return json_response(state, status_code=202)
+
+
+async def get_replay(request):
+    state = replay_manager.status(request.path_params['job_id'])
+    if state:
+        return json_response(state)
+    return json_response({'error': 'Replay not found'}, status_code=404)
+
+
+async def resume_replay(request):
+    state = replay_manager.resume(request.path_params['job_id'])
+    if state:
+        return json_response(state, status_code=202)
+    return json_response({'error': 'Replay not found'}, status_code=404)
+
+
+async def get_sampling_policies(request):
+    return json_response(await asyncio.to_thread(load_policies, redis_conn))
+
+
+async def put_sampling_policy(request):
+    body = await request_body(request)
+    try:
+        policy = await asyncio.to_thread(set_policy, redis_conn, request.path_params['topic'], body)
+    except InvalidPolicy as e:
+        return json_response({'error': str(e)}, status_code=400)
+    return json_response(policy)
+
+
+async def delete_sampling_policy(request):
+    if await asyncio.to_thread(delete_policy, redis_conn, request.path_params['topic']):
+        return Response(status_code=204)
+    return json_response({'error': 'Policy not found'}, status_code=404)
+
+
+@with_deadline
+async def get_stats(request):
+    args = request.query_params
+    filters = {name: args[name] for name in STATS_FILTERS if name in args}
+    return json_response(await read_controller.get_stats(
+        bucket=args.get('bucket', '1h'),
+        filters=filters,
+        limit=int_arg(request, 'limit')
+    ))
+
+
+async def get_metrics(request):
+    return PlainTextResponse(metrics_sampler.render(), media_type='text/plain; version=0.0.4')
+
+
+async def get_pool_stats(request):
+    return json_response(read_controller.pool_stats())
+
+
+async def get_cache_stats(request):
+    return json_response(read_controller.cache_stats())
+
+
+async def get_consumer_lag(request):
+    return json_response(await asyncio.to_thread(consumer_lag, redis_conn))
+
+
+async def handle_pool_timeout(request, exc):
+    return json_response({'error': str(exc)}, status_code=503)
+
+
+async def handle_invalid_query(request, exc):
+    return json_response({'error': str(exc)}, status_code=400)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await read_controller.open()
+    metrics_sampler.start()
+    yield
+    await read_controller.close()
+
+
+routes = [
+    # these are registered before the UUID route so they are not taken for a UUID
+    Route('/messages/search', search_messages, methods=['GET']),
+    Route('/messages/conversation', get_conversation, methods=['GET']),
+    Route('/messages/subject/{subject_id}', get_messages_by_subject, methods=['GET']),
+    Route('/messages/{message_uuid}', get_message, methods=['GET']),
+    Route('/exports', start_export, methods=['POST']),
+    Route('/exports/{job_id}', get_export, methods=['GET']),
+    Route('/exports/{job_id}/resume', resume_export, methods=['POST']),
+    Route('/replays', start_replay, methods=['POST']),
+    Route('/replays/{job_id}', get_replay, methods=['GET']),
+    Route('/replays/{job_id}/resume', resume_replay, methods=['POST']),
+    Route('/sampling', get_sampling_policies, methods=['GET']),
+    Route('/sampling/{topic}', put_sampling_policy, methods=['PUT']),
+    Route('/sampling/{topic}', delete_sampling_policy, methods=['DELETE']),
+    Route('/stats', get_stats, methods=['GET']),
+    Route('/metrics', get_metrics, methods=['GET']),
+    Route('/metrics/pool', get_pool_stats, methods=['GET']),
+    Route('/metrics/cache', get_cache_stats, methods=['GET']),
+    Route('/metrics/consumers', get_consumer_lag, methods=['GET']),
+]
+
+app = Starlette(
+    routes=routes,
+    lifespan=lifespan,
+    exception_handlers={
+        PoolTimeout: handle_pool_timeout,
+        AsyncPoolTimeout: handle_pool_timeout,
+        InvalidQuery: handle_invalid_query,
+    }
+)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host='0.0.0.0', port=Config.ASYNC_API_PORT)
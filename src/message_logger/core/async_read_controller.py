@@ -0,0 +1,173 @@
+import asyncio
+import uuid
+
+from psycopg_pool import AsyncConnectionPool
+
+from .cache import MessageCache
+from .archive import MessageArchive, pq
+from .config import Config
+from .read_controller import needs_archive
+from .queries import (
+    row_to_dict, encode_cursor, decode_cursor, build_search_query, build_subject_query,
+    build_stats_query, build_conversation_query, check_plan, project, page_limit, STATS_PERCENTILES_QUERY
+)
+
+
+def create_async_pool():
+    # the server-side timeout never outlives the request that issued the query
+    statement_timeout_ms = min(Config.DB_STATEMENT_TIMEOUT_MS, int(Config.ASYNC_REQUEST_TIMEOUT * 1000))
+    return AsyncConnectionPool(
+        min_size=Config.DB_POOL_MIN,
+        max_size=Config.DB_POOL_MAX,
+        timeout=Config.DB_POOL_TIMEOUT,
+        kwargs={
+            'host': Config.DB_HOST,
+            'port': Config.DB_PORT,
+            'user': Config.DB_USER,
+            'password': Config.DB_PASSWORD,
+            'dbname': Config.DB_NAME,
+            'options': '-c statement_timeout={}'.format(statement_timeout_ms)
+        },
+        open=False
+    )
+
+
+class AsyncReadController:
+    """
+    ReadController on psycopg 3's async driver. Queries are built by the
+    same helpers as the Flask read path, so both APIs return identical
+    pages and cursors. Cancelling a request task also cancels its query on
+    the server, and the connection goes back to the pool. The archive tier
+    and the optional Redis cache are blocking and run in worker threads.
+    """
+
+    def __init__(self, pool=None, cache=None, archive=None):
+        self.pool = pool or create_async_pool()
+        self.cache = cache or MessageCache()
+        if archive is None and Config.ARCHIVE_FALLBACK and pq is not None:
+            archive = MessageArchive()
+        self.archive = archive
+        self.stats_percentiles = None
+
+    async def open(self):
+        await self.pool.open()
+
+    async def close(self):
+        await self.pool.close()
+
+    async def _fetch(self, query, params):
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params)
+                rows = await cur.fetchall()
+                columns = [d.name for d in cur.description]
+        return [row_to_dict(columns, row) for row in rows]
+
+    async def _cache_get(self, message_uuid):
+        if self.cache.redis_conn is None:
+            return self.cache.get(message_uuid)
+        return await asyncio.to_thread(self.cache.get, message_uuid)
+
+    async def _cache_put(self, message):
+        if self.cache.redis_conn is None:
+            self.cache.put(message)
+        else:
+            await asyncio.to_thread(self.cache.put, message)
+
+    async def get_message_by_uuid(self, message_uuid):
+        message = await self._cache_get(message_uuid)
+        if message is not None:
+            return message
+
+        try:
+            uuid.UUID(str(message_uuid))
+        except ValueError:
+            return None
+
+        rows = await self._fetch("SELECT * FROM message_exchange WHERE message_uuid = %s", (message_uuid,))
+        message = rows[0] if rows else None
+        if message is None and self.archive is not None:
+            message = await asyncio.to_thread(self.archive.get_message, message_uuid)
+        if message is None:
+            return None
+
+        await self._cache_put(message)
+        return message
+
+    async def get_messages_by_subject(self, subject_id, limit=None, cursor=None, fields=None):
+        query, params = build_subject_query(subject_id, cursor, fields)
+        return await self._page(query, params, limit)
+
+    async def get_conversation(self, subject_a, subject_b, limit=None, cursor=None, fields=None,
+                               start=None, end=None):
+        query, params = build_conversation_query(subject_a, subject_b, cursor, fields, start, end)
+        return await self._page(query, params, limit)
+
+    async def _page(self, query, params, limit=None):
+        limit = page_limit(limit)
+        query += " LIMIT %s"
+        params.append(limit + 1)
+
+        rows = await self._fetch(query, params)
+        messages = rows[:limit]
+        next_cursor = encode_cursor(messages[-1]) if len(rows) > limit else None
+        return messages, next_cursor
+
+    async def search_messages(self, filters, limit=None, cursor=None, sort='time', fields=None):
+        limit = page_limit(limit)
+        query, params = build_search_query(filters, cursor, sort=sort, fields=fields)
+
+        messages = []
+        if self.archive is not None and sort == 'time':
+            after = decode_cursor(cursor) if cursor else None
+            if await asyncio.to_thread(needs_archive, self.archive, filters, after):
+                messages, resume = await asyncio.to_thread(self.archive.search, filters, after, limit + 1)
+                messages = [project(m, fields) for m in messages]
+                if len(messages) > limit:
+                    return messages[:limit], encode_cursor(messages[limit - 1])
+                if resume is not None:
+                    return messages, encode_cursor({'origin_ts': resume[0], 'message_uuid': resume[1]})
+                if messages:
+                    query, params = build_search_query(filters, encode_cursor(messages[-1]), fields=fields)
+
+        query += " LIMIT %s"
+        params.append(limit + 1 - len(messages))
+
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                if Config.SEARCH_PLAN_GUARD:
+                    await cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+                    check_plan((await cur.fetchone())[0][0]['Plan'])
+                await cur.execute(query, params)
+                rows = await cur.fetchall()
+                columns = [d.name for d in cur.description]
+
+        messages.extend(row_to_dict(columns, row) for row in rows)
+        has_more = len(messages) > limit and sort == 'time'
+        next_cursor = encode_cursor(messages[limit - 1]) if has_more else None
+        return messages[:limit], next_cursor
+
+    async def get_stats(self, bucket='1h', filters=None, limit=None):
+        if self.stats_percentiles is None:
+            self.stats_percentiles = bool(await self._fetch(STATS_PERCENTILES_QUERY, ()))
+        query, params = build_stats_query(bucket, filters, limit, self.stats_percentiles)
+        return await self._fetch(query, params)
+
+    async def stream_messages_by_subject(self, subject_id, cursor=None, fields=None):
+        """Yields a subject's history through a server-side cursor, STREAM_FETCH_SIZE rows at a time."""
+        query, params = build_subject_query(subject_id, cursor, fields)
+        async with self.pool.connection() as conn:
+            async with conn.cursor(name='stream_{}'.format(uuid.uuid4().hex)) as cur:
+                cur.itersize = Config.STREAM_FETCH_SIZE
+                await cur.execute(query, params)
+                columns = None
+                async for row in cur:
+                    if columns is None:
+                        columns = [d.name for d in cur.description]
+                    yield row_to_dict(columns, row)
+
+    def pool_stats(self):
+        return self.pool.get_stats()
+
+    def cache_stats(self):
+        return self.cache.stats()
@@ -0,0 +1,105 @@
+import logging
+
+from .config import Config
+from .pool import DBPool
+
+logger = logging.getLogger(__name__)
+
+# one window of history, [lo, lo + window), per statement
+BACKFILLS = {
+    'message_search': """
+        INSERT INTO message_search (message_uuid, origin_ts, message_tsv)
+        SELECT message_uuid, origin_ts,
+               jsonb_to_tsvector(%(fts_config)s::regconfig, COALESCE(message_data, '{}'::jsonb), '["string"]')
+        FROM message_exchange
+        WHERE origin_ts >= %(lo)s AND origin_ts < %(lo)s + %(window)s::interval
+        ON CONFLICT DO NOTHING
+        """,
+    'message_conversation': """
+        INSERT INTO message_conversation (subject_a, subject_b, origin_ts, message_uuid)
+        SELECT DISTINCT LEAST(m.source_subject_id, d), GREATEST(m.source_subject_id, d),
+               m.origin_ts, m.message_uuid
+        FROM message_exchange m, unnest(m.destination_subject_ids) AS d
+        WHERE m.source_subject_id IS NOT NULL AND d IS NOT NULL
+          AND m.origin_ts >= %(lo)s AND m.origin_ts < %(lo)s + %(window)s::interval
+        ON CONFLICT DO NOTHING
+        """,
+}
+
+
+def backfill_step(conn, name):
+    """
+    Indexes the next BACKFILL_WINDOW of history for the side table `name`
+    and records the new position in the same transaction, so an interrupted
+    backfill resumes where it stopped. Returns False once the backfill is
+    complete, or while another process is running it.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT position FROM schema_backfills WHERE name = %s AND completed_at IS NULL "
+            "FOR UPDATE SKIP LOCKED",
+            (name,)
+        )
+        row = cur.fetchone()
+        if row is None:
+            conn.rollback()
+            return False
+        position = row[0]
+        if position is None:
+            cur.execute("SELECT min(origin_ts) FROM message_exchange")
+            position = cur.fetchone()[0]
+        if position is not None:
+            cur.execute(
+                BACKFILLS[name],
+                {'lo': position, 'window': Config.BACKFILL_WINDOW, 'fts_config': Config.FTS_CONFIG}
+            )
+            # jump over empty stretches of history; rows written after the
+            # trigger existed are indexed by the trigger itself
+            cur.execute(
+                "SELECT min(origin_ts) FROM message_exchange WHERE origin_ts >= %s + %s::interval",
+                (position, Config.BACKFILL_WINDOW)
+            )
+            position = cur.fetchone()[0]
+        if position is None:
+            cur.execute("UPDATE schema_backfills SET completed_at = now() WHERE name = %s", (name,))
+        else:
+            cur.execute("UPDATE schema_backfills SET position = %s WHERE name = %s", (position, name))
+    conn.commit()
+    return position is not None
+
+
+def run_backfills(pool=None, stopped=None):
+    """Runs every pending side table backfill; returns the number of windows indexed."""
+    own_pool = pool is None
+    pool = pool or DBPool(minconn=1, maxconn=1)
+    windows = 0
+    try:
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT to_regclass('schema_backfills')")
+                if cur.fetchone()[0] is None:
+                    return windows
+                cur.execute("SELECT name FROM schema_backfills WHERE completed_at IS NULL ORDER BY name")
+                names = [row[0] for row in cur.fetchall()]
+            conn.commit()
+            for name in names:
+                if name not in BACKFILLS:
+                    logger.warning(f"Skipping unknown backfill {name}")
+                    continue
+                logger.info(f"Backfilling {name}")
+                while not (stopped is not None and stopped.is_set()) and backfill_step(conn, name):
+                    windows += 1
+    finally:
+        if own_pool:
+            pool.close()
+    return windows
+
+
+def run_backfiller():
+    windows = run_backfills()
+    logger.info(f"Backfill run complete, {windows} windows indexed")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run_backfiller()
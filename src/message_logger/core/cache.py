@@ -0,0 +1,134 @@
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+import redis
+from .config import Config
+from .db import MESSAGE_COLUMNS, parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY_PREFIX = 'message_logger:message:'
+
+
+def record_to_message(record):
+    """Converts a writer tuple into the dict shape served by the read API."""
+    message = dict(zip(MESSAGE_COLUMNS, record))
+    for column in ('origin_ts', 'ack_ts'):
+        if message[column] is not None:
+            message[column] = parse_timestamp(message[column]).isoformat()
+    for column in ('message_data', 'message_metadata'):
+        if isinstance(message[column], str):
+            message[column] = json.loads(message[column])
+    return message
+
+
+class MessageCache:
+    """
+    Read-through cache for messages by UUID. Messages are immutable once
+    written, so entries never need invalidating; the in-process tier is an
+    LRU bounded by the encoded size of its entries, and an optional Redis
+    tier is shared between API replicas and the writer. Redis failures are
+    logged and treated as misses, so an outage only costs cache hits.
+    """
+
+    def __init__(self, max_bytes=None, redis_conn=None, redis_ttl=None):
+        self.max_bytes = max_bytes if max_bytes is not None else Config.CACHE_MAX_BYTES
+        self.redis_ttl = redis_ttl if redis_ttl is not None else Config.CACHE_REDIS_TTL
+        if redis_conn is None and Config.CACHE_REDIS_ENABLED:
+            redis_conn = redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT)
+        self.redis_conn = redis_conn
+
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.redis_errors = 0
+
+    def _put_local(self, key, message, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = (message, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def get(self, message_uuid):
+        key = str(message_uuid)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.local_hits += 1
+                return entry[0]
+
+        encoded = None
+        if self.redis_conn is not None:
+            try:
+                encoded = self.redis_conn.get(REDIS_KEY_PREFIX + key)
+            except redis.RedisError as e:
+                self._redis_failed('read', e)
+            if encoded is not None:
+                message = json.loads(encoded)
+                self._put_local(key, message, len(encoded))
+                with self.lock:
+                    self.redis_hits += 1
+                return message
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, message):
+        key = message['message_uuid']
+        encoded = json.dumps(message)
+        self._put_local(key, message, len(encoded))
+        if self.redis_conn is not None:
+            try:
+                self.redis_conn.set(REDIS_KEY_PREFIX + key, encoded, ex=self.redis_ttl)
+            except redis.RedisError as e:
+                self._redis_failed('write', e)
+
+    def _redis_failed(self, operation, error):
+        with self.lock:
+            self.redis_errors += 1
+        logger.warning(f"Redis cache {operation} failed: {error}")
+
+    def warm(self, messages, local=True):
+        """Seeds both tiers with freshly written messages in one Redis round trip."""
+        pipe = self.redis_conn.pipeline(transaction=False) if self.redis_conn is not None else None
+        for message in messages:
+            encoded = json.dumps(message)
+            if local:
+                self._put_local(message['message_uuid'], message, len(encoded))
+            if pipe is not None:
+                pipe.set(REDIS_KEY_PREFIX + message['message_uuid'], encoded, ex=self.redis_ttl)
+        if pipe is not None:
+            pipe.execute()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.local_hits + self.redis_hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'local_hits': self.local_hits,
+                'redis_hits': self.redis_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'redis_errors': self.redis_errors,
+                'hit_ratio': (self.local_hits + self.redis_hits) / lookups if lookups else 0.0,
+                'redis_enabled': self.redis_conn is not None
+            }
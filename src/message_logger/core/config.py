@@ -13,3 +13,87 @@ class Config:
     
     BATCH_SIZE = int(os.getenv('BATCH_SIZE', 100))
     BATCH_INTERVAL = int(os.getenv('BATCH_INTERVAL', 10))  # in seconds
+
+    # values | copy | copy_binary
+    WRITE_STRATEGY = os.getenv('WRITE_STRATEGY', 'copy')
+
+    DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+    DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+    DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))  # checkout wait, in seconds
+    DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 30000))
+
+    CHUNK_TIME_INTERVAL = os.getenv('CHUNK_TIME_INTERVAL', '1 day')
+    # empty disables the policy
+    COMPRESS_AFTER = os.getenv('COMPRESS_AFTER', '7 days')
+    RETENTION_PERIOD = os.getenv('RETENTION_PERIOD', '')
+
+    PAGE_SIZE = int(os.getenv('PAGE_SIZE', 100))
+    MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 1000))
+    STREAM_FETCH_SIZE = int(os.getenv('STREAM_FETCH_SIZE', 1000))
+
+    SEARCH_PLAN_GUARD = int(os.getenv('SEARCH_PLAN_GUARD', 1))
+    SEARCH_MAX_SEQ_SCAN_COST = float(os.getenv('SEARCH_MAX_SEQ_SCAN_COST', 10000))
+
+    WS_CLIENT_QUEUE_SIZE = int(os.getenv('WS_CLIENT_QUEUE_SIZE', 1000))
+
+    CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    CACHE_REDIS_ENABLED = int(os.getenv('CACHE_REDIS_ENABLED', 0))
+    CACHE_REDIS_TTL = int(os.getenv('CACHE_REDIS_TTL', 3600))  # in seconds
+    CACHE_WARM_ON_WRITE = int(os.getenv('CACHE_WARM_ON_WRITE', 1))
+
+    REDIS_SHARDS = int(os.getenv('REDIS_SHARDS', 1))
+    CONSUMER_WORKERS = int(os.getenv('CONSUMER_WORKERS', 4))
+    CONSUMER_RETRY_BACKOFF = float(os.getenv('CONSUMER_RETRY_BACKOFF', 1))  # in seconds
+    # consecutive failed flushes before the batch is bisected to find rejected rows
+    CONSUMER_MAX_RETRIES = int(os.getenv('CONSUMER_MAX_RETRIES', 3))
+    CONSUMER_STATS_KEY = 'MESSAGES:consumers'
+
+    # must outlast BATCH_INTERVAL plus a flush cut off by DB_STATEMENT_TIMEOUT_MS
+    CONSUMER_HEARTBEAT_TTL = int(os.getenv('CONSUMER_HEARTBEAT_TTL', 90))  # in seconds
+    CONSUMER_RECOVERY_INTERVAL = int(os.getenv('CONSUMER_RECOVERY_INTERVAL', 30))  # in seconds
+    DEAD_LETTER_QUEUE = 'MESSAGES:dead'
+
+    EXPORT_DIR = os.getenv('EXPORT_DIR', '/exports')
+    EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', 50000))
+    EXPORT_PARQUET_COMPRESSION = os.getenv('EXPORT_PARQUET_COMPRESSION', 'zstd')
+
+    # empty disables archival
+    ARCHIVE_AFTER = os.getenv('ARCHIVE_AFTER', '30 days')
+    ARCHIVE_STORE = os.getenv('ARCHIVE_STORE', 'local')  # local | s3
+    ARCHIVE_LOCAL_PATH = os.getenv('ARCHIVE_LOCAL_PATH', '/archive')
+    ARCHIVE_ROWS_PER_OBJECT = int(os.getenv('ARCHIVE_ROWS_PER_OBJECT', 100000))
+    ARCHIVE_FALLBACK = int(os.getenv('ARCHIVE_FALLBACK', 1))
+    ARCHIVE_SEARCH_MAX_OBJECTS = int(os.getenv('ARCHIVE_SEARCH_MAX_OBJECTS', 8))  # objects read per search page
+    # how long archived messages stay findable by UUID; search by time is unaffected
+    ARCHIVE_INDEX_RETENTION = os.getenv('ARCHIVE_INDEX_RETENTION', '365 days')
+    ARCHIVE_WATERMARK_TTL = int(os.getenv('ARCHIVE_WATERMARK_TTL', 60))  # in seconds
+
+    FTS_CONFIG = os.getenv('FTS_CONFIG', 'simple')  # text search configuration
+    # origin_ts span indexed per transaction when backfilling side tables
+    BACKFILL_WINDOW = os.getenv('BACKFILL_WINDOW', '1 hour')
+
+    REPLAY_CHECKPOINT_DIR = os.getenv('REPLAY_CHECKPOINT_DIR', '/replays')
+    REPLAY_CHUNK_ROWS = int(os.getenv('REPLAY_CHUNK_ROWS', 1000))
+    REPLAY_RATE = float(os.getenv('REPLAY_RATE', 500))  # messages per second, 0 for unlimited
+    REPLAY_CONCURRENCY = int(os.getenv('REPLAY_CONCURRENCY', 8))
+    REPLAY_NATS_URL = os.getenv('REPLAY_NATS_URL', 'nats://localhost:4222')
+    REPLAY_FANOUT_URL = os.getenv('REPLAY_FANOUT_URL', 'http://localhost:5000')
+
+    METRICS_SAMPLE_INTERVAL = float(os.getenv('METRICS_SAMPLE_INTERVAL', 5))  # in seconds
+
+    ASYNC_API_PORT = int(os.getenv('ASYNC_API_PORT', 8000))
+    ASYNC_REQUEST_TIMEOUT = float(os.getenv('ASYNC_REQUEST_TIMEOUT', 10))  # in seconds
+    ASYNC_DISCONNECT_POLL = float(os.getenv('ASYNC_DISCONNECT_POLL', 0.5))  # in seconds
+
+    RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv('RESPONSE_COMPRESS_MIN_BYTES', 1024))
+    RESPONSE_GZIP_LEVEL = int(os.getenv('RESPONSE_GZIP_LEVEL', 6))
+    RESPONSE_ZSTD_LEVEL = int(os.getenv('RESPONSE_ZSTD_LEVEL', 3))
+
+    # JSON object of topic -> policy; entries in the Redis hash take precedence
+    SAMPLING_POLICIES = os.getenv('SAMPLING_POLICIES', '')
+    SAMPLING_POLICIES_KEY = 'MESSAGES:sampling'
+    SAMPLING_REFRESH_INTERVAL = float(os.getenv('SAMPLING_REFRESH_INTERVAL', 5))  # in seconds
+    SAMPLING_WINDOW = float(os.getenv('SAMPLING_WINDOW', 60))  # in seconds
+    SAMPLING_WINDOW_STATE_TTL = float(os.getenv('SAMPLING_WINDOW_STATE_TTL', 3600))  # in seconds
+    # how long dropped message ids are remembered to keep redelivered batches from being counted twice
+    SAMPLING_DEDUP_RETENTION = os.getenv('SAMPLING_DEDUP_RETENTION', '1 day')
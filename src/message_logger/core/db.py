@@ -1,44 +1,214 @@
+import io
+import struct
+import uuid
+from datetime import datetime, timezone
+
 import psycopg2
 from psycopg2.extras import Json
 from .config import Config
+from .pool import get_pool
+from .schema import migrate
+
+MESSAGE_COLUMNS = (
+    'message_uuid', 'origin_ts', 'ack_ts', 'message_data',
+    'source_subject_id', 'destination_subject_ids', 'topic',
+    'message_type', 'message_metadata'
+)
+
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+TEXT_OID = 25
+
+
+def _copy_text_escape(value):
+    return (
+        value.replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+
+def _text_array_literal(values):
+    items = []
+    for value in values:
+        if value is None:
+            items.append('NULL')
+        else:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+            items.append('"%s"' % value)
+    return '{' + ','.join(items) + '}'
+
+
+def _copy_text_field(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, (list, tuple)):
+        value = _text_array_literal(value)
+    return _copy_text_escape(str(value))
+
+
+def parse_timestamp(value):
+    if isinstance(value, datetime):
+        ts = value
+    elif isinstance(value, (int, float)):
+        ts = datetime.fromtimestamp(value, tz=timezone.utc)
+    else:
+        ts = datetime.fromisoformat(str(value))
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts
+
+
+def _binary_field(data):
+    if data is None:
+        return struct.pack('!i', -1)
+    return struct.pack('!i', len(data)) + data
+
+
+def _binary_text_array(values):
+    if not values:
+        return struct.pack('!iiI', 0, 0, TEXT_OID)
+    has_null = any(value is None for value in values)
+    out = [struct.pack('!iiIii', 1, int(has_null), TEXT_OID, len(values), 1)]
+    for value in values:
+        out.append(_binary_field(None if value is None else str(value).encode('utf-8')))
+    return b''.join(out)
+
+
+def _binary_timestamp(value):
+    delta = parse_timestamp(value) - PG_EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return struct.pack('!q', micros)
+
+
+def _binary_row(row):
+    (message_uuid, origin_ts, ack_ts, message_data, source_subject_id,
+     destination_subject_ids, topic, message_type, message_metadata) = row
+    fields = [
+        uuid.UUID(str(message_uuid)).bytes,
+        None if origin_ts is None else _binary_timestamp(origin_ts),
+        None if ack_ts is None else _binary_timestamp(ack_ts),
+        None if message_data is None else b'\x01' + message_data.encode('utf-8'),
+        None if source_subject_id is None else source_subject_id.encode('utf-8'),
+        None if destination_subject_ids is None else _binary_text_array(destination_subject_ids),
+        None if topic is None else topic.encode('utf-8'),
+        None if message_type is None else message_type.encode('utf-8'),
+        None if message_metadata is None else b'\x01' + message_metadata.encode('utf-8'),
+    ]
+    return struct.pack('!h', len(fields)) + b''.join(_binary_field(f) for f in fields)
+
+
+def build_copy_buffer(messages, binary=False):
+    """Serialise message tuples into an in-memory COPY FROM STDIN payload."""
+    if binary:
+        buf = io.BytesIO()
+        buf.write(PGCOPY_HEADER)
+        for row in messages:
+            buf.write(_binary_row(row))
+        buf.write(PGCOPY_TRAILER)
+    else:
+        buf = io.StringIO()
+        for row in messages:
+            buf.write('\t'.join(_copy_text_field(value) for value in row))
+            buf.write('\n')
+    buf.seek(0)
+    return buf
+
 
 class TimescaleDB:
-    def __init__(self):
-        self.conn = psycopg2.connect(
-            host=Config.DB_HOST,
-            port=Config.DB_PORT,
-            user=Config.DB_USER,
-            password=Config.DB_PASSWORD,
-            dbname=Config.DB_NAME
-        )
+    def __init__(self, table_name='message_exchange', pool=None):
+        self.table_name = table_name
+        self.pool = pool or get_pool()
         self.create_table()
 
+    def connection(self):
+        return self.pool.connection()
+
     def create_table(self):
-        query = """
-        CREATE TABLE IF NOT EXISTS message_exchange (
-            message_uuid UUID PRIMARY KEY,
-            origin_ts TIMESTAMPTZ,
-            ack_ts TIMESTAMPTZ,
-            message_data JSONB,
-            source_subject_id TEXT,
-            destination_subject_ids TEXT[],
-            topic TEXT,
-            message_type TEXT,
-            message_metadata JSONB
-        );
-        """
-        with self.conn.cursor() as cur:
-            cur.execute(query)
-            self.conn.commit()
+        with self.connection() as conn:
+            migrate(conn)
 
-    def batch_insert(self, messages):
+    def batch_insert(self, messages, strategy=None):
+        strategy = strategy or Config.WRITE_STRATEGY
+        if strategy == 'copy':
+            return self.copy_insert(messages)
+        if strategy == 'copy_binary':
+            return self.copy_insert(messages, binary=True)
+        return self.values_insert(messages)
+
+    def values_insert(self, messages):
         query = """
-        INSERT INTO message_exchange (
-            message_uuid, origin_ts, ack_ts, message_data, 
-            source_subject_id, destination_subject_ids, topic, 
+        INSERT INTO {table} (
+            message_uuid, origin_ts, ack_ts, message_data,
+            source_subject_id, destination_subject_ids, topic,
             message_type, message_metadata
         ) VALUES %s
+        ON CONFLICT DO NOTHING
+        """.format(table=self.table_name)
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                psycopg2.extras.execute_values(cur, query, messages)
+            conn.commit()
+
+    def copy_insert(self, messages, binary=False):
+        # COPY into a session-local staging table, then move the rows across
+        # with ON CONFLICT DO NOTHING so a replayed batch is a no-op.
+        staging = '{}_staging'.format(self.table_name)
+        columns = ', '.join(MESSAGE_COLUMNS)
+        copy_sql = "COPY {staging} ({columns}) FROM STDIN{options}".format(
+            staging=staging,
+            columns=columns,
+            options=" WITH (FORMAT binary)" if binary else ""
+        )
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "CREATE TEMP TABLE IF NOT EXISTS {staging} "
+                    "(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS".format(
+                        staging=staging, table=self.table_name
+                    )
+                )
+                cur.copy_expert(copy_sql, build_copy_buffer(messages, binary=binary))
+                cur.execute(
+                    "INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} "
+                    "ON CONFLICT DO NOTHING".format(
+                        table=self.table_name, columns=columns, staging=staging
+                    )
+                )
+            conn.commit()
+
+    def upsert_sampled_counts(self, rows):
         """
-        with self.conn.cursor() as cur:
-            psycopg2.extras.execute_values(cur, query, messages)
-            self.conn.commit()
+        Counts (bucket, topic, message_type, source, policy, message_uuid,
+        origin_ts) rows of dropped messages into message_sampled_counts.
+        Each message is recorded in message_sampled_ids and only counted the
+        first time, so a redelivered batch is not counted twice.
+        """
+        query = (
+            "WITH dropped AS ("
+            "SELECT DISTINCT * FROM (VALUES %s) AS v "
+            "(bucket, topic, message_type, source_subject_id, policy, message_uuid, origin_ts)"
+            "), new AS ("
+            "INSERT INTO message_sampled_ids (message_uuid, origin_ts) "
+            "SELECT message_uuid::uuid, origin_ts::timestamptz FROM dropped "
+            "ON CONFLICT DO NOTHING RETURNING message_uuid, origin_ts"
+            ") "
+            "INSERT INTO message_sampled_counts "
+            "(bucket, topic, message_type, source_subject_id, policy, message_count) "
+            "SELECT d.bucket::timestamptz, d.topic, d.message_type, d.source_subject_id, d.policy, count(*) "
+            "FROM dropped d JOIN new n "
+            "ON n.message_uuid = d.message_uuid::uuid AND n.origin_ts = d.origin_ts::timestamptz "
+            "GROUP BY 1, 2, 3, 4, 5 "
+            "ON CONFLICT (bucket, topic, message_type, source_subject_id, policy) "
+            "DO UPDATE SET message_count = message_sampled_counts.message_count + EXCLUDED.message_count"
+        )
+        rows = [
+            (datetime.fromtimestamp(row[0], tz=timezone.utc),) + tuple(row[1:5]) + (str(row[5]), str(row[6]))
+            for row in rows
+        ]
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                psycopg2.extras.execute_values(cur, query, rows)
+            conn.commit()
@@ -0,0 +1,60 @@
+import gzip
+import json
+
+from .config import Config
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+def accepted(header, values):
+    """Whether a comma-separated Accept-style header lists any of `values` with a non-zero q."""
+    for part in (header or '').split(','):
+        token, *params = [p.strip() for p in part.split(';')]
+        if token.lower() not in values:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            return True
+    return False
+
+
+def encode_response(content, accept=None, accept_encoding=None):
+    """
+    Serialises a response body as JSON, or msgpack when the client asks for
+    it, and compresses it with zstd or gzip when the client accepts either
+    and the body is at least RESPONSE_COMPRESS_MIN_BYTES. Returns the body
+    and the headers to send with it.
+    """
+    if msgpack is not None and accepted(accept, MSGPACK_TYPES):
+        body = msgpack.packb(content, default=str, use_bin_type=True)
+        content_type = 'application/msgpack'
+    else:
+        body = json.dumps(content, default=str).encode('utf-8')
+        content_type = 'application/json'
+
+    headers = {'Content-Type': content_type, 'Vary': 'Accept, Accept-Encoding'}
+    if len(body) >= Config.RESPONSE_COMPRESS_MIN_BYTES:
+        if zstandard is not None and accepted(accept_encoding, ('zstd',)):
+            body = zstandard.ZstdCompressor(level=Config.RESPONSE_ZSTD_LEVEL).compress(body)
+            headers['Content-Encoding'] = 'zstd'
+        elif accepted(accept_encoding, ('gzip',)):
+            body = gzip.compress(body, compresslevel=Config.RESPONSE_GZIP_LEVEL)
+            headers['Content-Encoding'] = 'gzip'
+    return body, headers
@@ -0,0 +1,200 @@
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from .config import Config
+from .db import MESSAGE_COLUMNS
+from .queries import build_search_query, encode_cursor, row_to_dict, SEARCH_FILTERS
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('parquet', 'ndjson')
+
+
+def parquet_schema():
+    return pa.schema([
+        ('message_uuid', pa.string()),
+        ('origin_ts', pa.timestamp('us', tz='UTC')),
+        ('ack_ts', pa.timestamp('us', tz='UTC')),
+        ('message_data', pa.string()),
+        ('source_subject_id', pa.string()),
+        ('destination_subject_ids', pa.list_(pa.string())),
+        ('topic', pa.string()),
+        ('message_type', pa.string()),
+        ('message_metadata', pa.string()),
+    ])
+
+
+def write_parquet(path, columns, rows):
+    """Writes raw rows to a compressed Parquet file; JSONB columns are stored as JSON text."""
+    data = {column: [] for column in MESSAGE_COLUMNS}
+    for row in rows:
+        for column, value in zip(columns, row):
+            if column not in data:
+                continue
+            if column in ('message_data', 'message_metadata') and value is not None:
+                value = json.dumps(value)
+            elif column == 'message_uuid':
+                value = str(value)
+            data[column].append(value)
+    table = pa.table(data, schema=parquet_schema())
+    pq.write_table(table, path, compression=Config.EXPORT_PARQUET_COMPRESSION)
+
+
+def write_ndjson(path, messages):
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for message in messages:
+            f.write(json.dumps(message, default=str))
+            f.write('\n')
+
+
+class ExportJob:
+    """
+    Exports a filtered slice of message_exchange into numbered part files.
+
+    Rows are read through a server-side cursor one chunk at a time and each
+    chunk becomes its own part, so memory stays bounded by EXPORT_CHUNK_ROWS.
+    The manifest is rewritten after every part with the keyset cursor of the
+    last exported row, which is what lets an interrupted job resume.
+    """
+
+    def __init__(self, db, job_id, filters=None, fmt='parquet', export_dir=None):
+        self.db = db
+        self.job_id = job_id
+        self.job_dir = os.path.join(export_dir or Config.EXPORT_DIR, job_id)
+        self.manifest_path = os.path.join(self.job_dir, 'manifest.json')
+
+        manifest = self.load_manifest(self.manifest_path)
+        fmt = manifest['format'] if manifest else fmt
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError("Unsupported export format: {}".format(fmt))
+        if fmt == 'parquet' and pa is None:
+            raise ValueError("Parquet export requires pyarrow")
+
+        os.makedirs(self.job_dir, exist_ok=True)
+        self.manifest = manifest or {
+            'job_id': job_id,
+            'format': fmt,
+            'filters': {k: v for k, v in (filters or {}).items() if k in SEARCH_FILTERS},
+            'status': 'pending',
+            'rows_written': 0,
+            'parts': [],
+            'cursor': None,
+            'position': None,
+            'error': None,
+            'created_at': time.time(),
+            'updated_at': time.time()
+        }
+
+    @staticmethod
+    def load_manifest(path):
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def save_manifest(self):
+        self.manifest['updated_at'] = time.time()
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def write_part(self, columns, rows):
+        index = len(self.manifest['parts'])
+        extension = 'parquet' if self.manifest['format'] == 'parquet' else 'ndjson.gz'
+        name = 'part-{:05d}.{}'.format(index, extension)
+        path = os.path.join(self.job_dir, name)
+        tmp_path = path + '.tmp'
+
+        if self.manifest['format'] == 'parquet':
+            write_parquet(tmp_path, columns, rows)
+        else:
+            write_ndjson(tmp_path, [row_to_dict(columns, row) for row in rows])
+        os.replace(tmp_path, path)
+
+        last = row_to_dict(columns, rows[-1])
+        self.manifest['parts'].append({'file': name, 'rows': len(rows)})
+        self.manifest['rows_written'] += len(rows)
+        self.manifest['cursor'] = encode_cursor(last)
+        self.manifest['position'] = last['origin_ts']
+        self.save_manifest()
+
+    def run(self):
+        if self.manifest['status'] == 'completed':
+            return self.manifest
+
+        self.manifest['status'] = 'running'
+        self.manifest['error'] = None
+        self.save_manifest()
+
+        query, params = build_search_query(self.manifest['filters'], self.manifest['cursor'])
+        try:
+            with self.db.connection() as conn:
+                with conn.cursor(name='export_{}'.format(uuid.uuid4().hex)) as cur:
+                    cur.itersize = Config.EXPORT_CHUNK_ROWS
+                    cur.execute(query, params)
+                    while True:
+                        rows = cur.fetchmany(Config.EXPORT_CHUNK_ROWS)
+                        if not rows:
+                            break
+                        self.write_part([d.name for d in cur.description], rows)
+
+            self.manifest['status'] = 'completed'
+        except Exception as e:
+            logger.error(f"Export {self.job_id} failed after {self.manifest['rows_written']} rows: {e}")
+            self.manifest['status'] = 'failed'
+            self.manifest['error'] = str(e)
+        self.save_manifest()
+        return self.manifest
+
+
+class ExportManager:
+    def __init__(self, db, export_dir=None):
+        self.db = db
+        self.export_dir = export_dir or Config.EXPORT_DIR
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def _run_in_background(self, job):
+        with self.lock:
+            running = self.threads.get(job.job_id)
+            if running is not None and running.is_alive():
+                return
+            thread = threading.Thread(target=job.run, daemon=True)
+            self.threads[job.job_id] = thread
+            thread.start()
+
+    def start(self, filters, fmt='parquet'):
+        # validate the filters before handing the job to a thread
+        build_search_query({k: v for k, v in filters.items() if k in SEARCH_FILTERS})
+        job = ExportJob(self.db, uuid.uuid4().hex, filters=filters, fmt=fmt, export_dir=self.export_dir)
+        job.save_manifest()
+        self._run_in_background(job)
+        return job.manifest
+
+    def resume(self, job_id):
+        manifest = self.status(job_id)
+        if manifest is None:
+            return None
+        job = ExportJob(self.db, manifest['job_id'], export_dir=self.export_dir)
+        self._run_in_background(job)
+        return job.manifest
+
+    def status(self, job_id):
+        try:
+            job_id = uuid.UUID(job_id).hex
+        except ValueError:
+            return None
+        return ExportJob.load_manifest(os.path.join(self.export_dir, job_id, 'manifest.json'))
@@ -0,0 +1,173 @@
+import json
+import logging
+import threading
+import time
+
+import redis
+from .config import Config
+from .db import parse_timestamp
+from .redis_consumer import shard_queues
+
+logger = logging.getLogger(__name__)
+
+WORKER_GAUGES = (
+    ('buffered', 'message_logger_worker_buffered_messages', 'Messages buffered by the worker and not yet written.'),
+    ('oldest_buffered_age', 'message_logger_worker_oldest_buffered_age_seconds',
+     'Age of the oldest message buffered by the worker.'),
+    ('last_flush_size', 'message_logger_worker_last_flush_size', 'Rows written by the last batch flush.'),
+    ('last_flush_seconds', 'message_logger_worker_last_flush_seconds', 'Duration of the last batch flush.'),
+)
+
+WORKER_COUNTERS = (
+    ('flushes', 'message_logger_worker_flushes_total', 'Batch flushes committed.'),
+    ('written', 'message_logger_worker_written_total', 'Rows written.'),
+    ('failures', 'message_logger_worker_failures_total', 'Failed batch flushes.'),
+    ('rejected', 'message_logger_worker_rejected_total', 'Rows rejected by the database and dead-lettered.'),
+    ('flush_seconds_total', 'message_logger_worker_flush_seconds_total', 'Time spent in batch flushes.'),
+)
+
+
+def _queued_age(raw, now):
+    try:
+        return now - parse_timestamp(json.loads(raw)['origin_ts']).timestamp()
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def _labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels.items()) + '}'
+
+
+class MetricsSampler:
+    """
+    Samples queue depth and consumer stats from Redis on a background thread
+    every METRICS_SAMPLE_INTERVAL seconds. Scrapes only render the latest
+    snapshot, so they never touch Redis, and the consumers themselves are
+    never queried: they already publish their stats on every flush.
+    """
+
+    def __init__(self, redis_conn=None, queues=None, interval=None):
+        self.redis_conn = redis_conn or redis.StrictRedis(
+            host=Config.REDIS_HOST, port=Config.REDIS_PORT, decode_responses=True
+        )
+        self.queues = queues or shard_queues()
+        self.interval = interval if interval is not None else Config.METRICS_SAMPLE_INTERVAL
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.previous = None
+        self.sample_errors = 0
+        self.thread = None
+
+    def sample(self):
+        now = time.time()
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for queue in self.queues:
+            pipe.llen(queue)
+            # producers RPUSH, so the head of the list is the oldest entry
+            pipe.lindex(queue, 0)
+        pipe.llen(Config.DEAD_LETTER_QUEUE)
+        pipe.hgetall(Config.CONSUMER_STATS_KEY)
+        results = pipe.execute()
+
+        queues = {}
+        for i, queue in enumerate(self.queues):
+            length, head = results[2 * i], results[2 * i + 1]
+            queues[queue] = {
+                'length': length,
+                'oldest_age': _queued_age(head, now) if head is not None else 0.0
+            }
+        dead_letter_length = results[-2]
+        workers = [json.loads(stats) for _, stats in sorted(results[-1].items())]
+
+        ages = [q['oldest_age'] for q in queues.values() if q['oldest_age'] is not None]
+        ages += [w.get('oldest_buffered_age', 0.0) for w in workers]
+        written = sum(w.get('written', 0) for w in workers)
+
+        insert_rate = 0.0
+        if self.previous is not None:
+            elapsed = now - self.previous['sampled_at']
+            # a restarted worker resets its counter, so never report a negative rate
+            if elapsed > 0:
+                insert_rate = max(written - self.previous['written'], 0) / elapsed
+
+        snapshot = {
+            'sampled_at': now,
+            'queues': queues,
+            'dead_letter_length': dead_letter_length,
+            'oldest_unpersisted_age': max(ages) if ages else 0.0,
+            'written': written,
+            'insert_rate': insert_rate,
+            'workers': workers
+        }
+        with self.lock:
+            self.previous = self.snapshot or snapshot
+            self.snapshot = snapshot
+        return snapshot
+
+    def run(self):
+        while True:
+            try:
+                self.sample()
+            except (redis.RedisError, ValueError) as e:
+                with self.lock:
+                    self.sample_errors += 1
+                logger.warning(f"Failed to sample consumer metrics: {e}")
+            time.sleep(self.interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def render(self):
+        """Latest snapshot in the Prometheus text exposition format."""
+        with self.lock:
+            snapshot = self.snapshot
+            sample_errors = self.sample_errors
+
+        lines = [
+            '# HELP message_logger_metrics_sample_errors_total Failed sampler runs.',
+            '# TYPE message_logger_metrics_sample_errors_total counter',
+            'message_logger_metrics_sample_errors_total {}'.format(sample_errors),
+        ]
+        if snapshot is None:
+            return '\n'.join(lines) + '\n'
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, labels, value))
+
+        metric('message_logger_metrics_sampled_at_seconds', 'gauge', 'Unix time of the last sample.',
+               [('', snapshot['sampled_at'])])
+        metric('message_logger_queue_length', 'gauge', 'Messages waiting in the Redis queue.',
+               [(_labels(queue=q), v['length']) for q, v in snapshot['queues'].items()])
+        metric('message_logger_queue_oldest_age_seconds', 'gauge', 'Age of the oldest message waiting in the queue.',
+               [(_labels(queue=q), v['oldest_age']) for q, v in snapshot['queues'].items()
+                if v['oldest_age'] is not None])
+        metric('message_logger_dead_letter_length', 'gauge', 'Messages in the dead-letter queue.',
+               [('', snapshot['dead_letter_length'])])
+        metric('message_logger_oldest_unpersisted_age_seconds', 'gauge',
+               'Age of the oldest message that is queued or buffered but not yet written.',
+               [('', snapshot['oldest_unpersisted_age'])])
+        metric('message_logger_insert_rate', 'gauge', 'Rows written per second across all workers.',
+               [('', snapshot['insert_rate'])])
+        metric('message_logger_workers', 'gauge', 'Consumer workers reporting stats.',
+               [('', len(snapshot['workers']))])
+
+        for key, name, help_text in WORKER_GAUGES:
+            metric(name, 'gauge', help_text,
+                   [(_labels(worker=w['worker_id']), w.get(key, 0)) for w in snapshot['workers']])
+        for key, name, help_text in WORKER_COUNTERS:
+            metric(name, 'counter', help_text,
+                   [(_labels(worker=w['worker_id']), w.get(key, 0)) for w in snapshot['workers']])
+
+        for key, help_text in (('kept', 'Messages of sampled topics persisted.'),
+                               ('dropped', 'Messages of sampled topics dropped or only counted.')):
+            metric('message_logger_sampling_{}_total'.format(key), 'counter', help_text, [
+                (_labels(worker=w['worker_id'], topic=topic, policy=stats['policy']), stats[key])
+                for w in snapshot['workers']
+                for topic, stats in sorted(w.get('sampling', {}).items())
+            ])
+        return '\n'.join(lines) + '\n'
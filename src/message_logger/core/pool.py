@@ -0,0 +1,120 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from psycopg2.pool import ThreadedConnectionPool
+from .config import Config
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class DBPool:
+    """
+    Thread-safe Postgres connection pool shared by the writer and the read API.
+
+    ThreadedConnectionPool raises as soon as it is exhausted, so checkouts are
+    gated by a semaphore and wait up to `checkout_timeout` seconds for a free
+    connection instead.
+    """
+
+    def __init__(self, minconn=None, maxconn=None, checkout_timeout=None, statement_timeout_ms=None):
+        self.minconn = minconn if minconn is not None else Config.DB_POOL_MIN
+        self.maxconn = maxconn if maxconn is not None else Config.DB_POOL_MAX
+        self.checkout_timeout = checkout_timeout if checkout_timeout is not None else Config.DB_POOL_TIMEOUT
+        statement_timeout_ms = (
+            statement_timeout_ms if statement_timeout_ms is not None else Config.DB_STATEMENT_TIMEOUT_MS
+        )
+
+        self.pool = ThreadedConnectionPool(
+            self.minconn,
+            self.maxconn,
+            host=Config.DB_HOST,
+            port=Config.DB_PORT,
+            user=Config.DB_USER,
+            password=Config.DB_PASSWORD,
+            dbname=Config.DB_NAME,
+            options='-c statement_timeout={}'.format(statement_timeout_ms)
+        )
+        self.slots = threading.BoundedSemaphore(self.maxconn)
+
+        self.stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.in_use = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def getconn(self):
+        start = time.monotonic()
+        if not self.slots.acquire(timeout=self.checkout_timeout):
+            with self.stats_lock:
+                self.checkout_timeouts += 1
+            raise PoolTimeout(
+                "No database connection available after {}s".format(self.checkout_timeout)
+            )
+        waited = time.monotonic() - start
+
+        try:
+            conn = self.pool.getconn()
+        except Exception:
+            self.slots.release()
+            raise
+
+        with self.stats_lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        return conn
+
+    def putconn(self, conn):
+        # roll back anything the caller left open so the next user starts clean
+        close = conn.closed != 0
+        if not close:
+            try:
+                conn.rollback()
+            except Exception:
+                close = True
+        try:
+            self.pool.putconn(conn, close=close)
+        finally:
+            with self.stats_lock:
+                self.in_use -= 1
+            self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'size': self.maxconn,
+                'in_use': self.in_use,
+                'checkouts': self.checkouts,
+                'checkout_timeouts': self.checkout_timeouts,
+                'wait_seconds_total': self.wait_seconds_total,
+                'wait_seconds_max': self.wait_seconds_max,
+                'wait_seconds_avg': self.wait_seconds_total / self.checkouts if self.checkouts else 0.0
+            }
+
+    def close(self):
+        self.pool.closeall()
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = DBPool()
+        return _shared_pool
@@ -0,0 +1,286 @@
+import base64
+import json
+import uuid
+from datetime import datetime
+
+from .config import Config
+from .db import MESSAGE_COLUMNS
+
+
+SEARCH_FILTERS = {
+    'start': "m.origin_ts >= %s::timestamptz",
+    'end': "m.origin_ts < %s::timestamptz",
+    'topic': "m.topic = %s",
+    'message_type': "m.message_type = %s",
+    'source': "m.source_subject_id = %s",
+    'destination': "m.destination_subject_ids @> ARRAY[%s]::text[]",
+    'metadata': "m.message_metadata @> %s::jsonb",
+    'q': "s.message_tsv @@ websearch_to_tsquery(%s::regconfig, %s)",
+}
+
+SEARCH_SORTS = ('time', 'rank')
+
+# everything but the payload columns; `fields=headers` selects these
+HEADER_FIELDS = tuple(c for c in MESSAGE_COLUMNS if c not in ('message_data', 'message_metadata'))
+
+STATS_VIEWS = {
+    '1m': 'message_stats_1m',
+    '1h': 'message_stats_1h',
+}
+
+STATS_FILTERS = {
+    'start': "bucket >= %s::timestamptz",
+    'end': "bucket < %s::timestamptz",
+    'topic': "topic = %s",
+    'message_type': "message_type = %s",
+    'source': "source_subject_id = %s",
+}
+
+
+# whether the rollups carry toolkit latency sketches (see schema migration 6)
+STATS_PERCENTILES_QUERY = (
+    "SELECT 1 FROM information_schema.columns "
+    "WHERE table_name = 'message_stats_1m' AND column_name = 'latency_ms'"
+)
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+class InvalidCursor(InvalidQuery):
+    pass
+
+
+class QueryRejected(InvalidQuery):
+    pass
+
+
+def row_to_dict(columns, row):
+    message = {}
+    for column, value in zip(columns, row):
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, uuid.UUID):
+            value = str(value)
+        message[column] = value
+    return message
+
+
+def seq_scans(plan):
+    """Yields every Seq Scan node over message_exchange or one of its chunks."""
+    if plan.get('Node Type') == 'Seq Scan':
+        relation = plan.get('Relation Name', '')
+        if relation == 'message_exchange' or relation.startswith('_hyper_'):
+            yield plan
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child)
+
+
+def parse_fields(value):
+    """
+    Parses a `fields=` projection into the columns to select, or None for
+    all of them. The keyset columns are always included so that paging
+    keeps working on projected results.
+    """
+    if not value:
+        return None
+    if value == 'headers':
+        names = HEADER_FIELDS
+    else:
+        names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names if name not in MESSAGE_COLUMNS]
+    if unknown:
+        raise QueryRejected("Unknown fields: {}".format(', '.join(unknown)))
+    return [c for c in MESSAGE_COLUMNS if c in names or c in ('origin_ts', 'message_uuid')]
+
+
+def select_list(fields, alias=''):
+    if fields is None:
+        return alias + '*'
+    return ', '.join(alias + field for field in fields)
+
+
+def project(message, fields):
+    """Applies a projection to a message read from a tier that cannot push it down."""
+    if fields is None:
+        return message
+    return {k: v for k, v in message.items() if k in fields or k == 'rank'}
+
+
+def check_plan(plan):
+    """Raises QueryRejected if an EXPLAIN plan has an expensive unindexed scan."""
+    # small chunks are legitimately seq-scanned, so only scans the planner
+    # expects to be expensive are treated as unindexed
+    for node in seq_scans(plan):
+        if node.get('Total Cost', 0) > Config.SEARCH_MAX_SEQ_SCAN_COST:
+            raise QueryRejected(
+                "Query requires an unindexed scan of {}; narrow the filters".format(
+                    node.get('Relation Name')
+                )
+            )
+
+
+def check_timestamp(name, value):
+    try:
+        datetime.fromisoformat(value)
+    except (ValueError, TypeError):
+        raise QueryRejected("Invalid {} timestamp: {}".format(name, value))
+
+
+def page_limit(limit):
+    """Requested page size clamped to 1..MAX_PAGE_SIZE; PAGE_SIZE when not given."""
+    return max(1, min(limit or Config.PAGE_SIZE, Config.MAX_PAGE_SIZE))
+
+
+def encode_cursor(message):
+    payload = json.dumps([message['origin_ts'], message['message_uuid']])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token):
+    try:
+        origin_ts, message_uuid = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        datetime.fromisoformat(origin_ts)
+        uuid.UUID(message_uuid)
+        return origin_ts, message_uuid
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor("Invalid cursor: {}".format(e))
+
+
+def build_search_query(filters, cursor=None, sort='time', fields=None):
+    """
+    Builds the /messages/search query. Results are ordered by
+    (origin_ts, message_uuid) for keyset paging; full-text queries may
+    instead be ordered by rank, which returns a single page.
+    """
+    if sort not in SEARCH_SORTS:
+        raise QueryRejected("Unsupported sort: {}".format(sort))
+
+    clauses, params = [], []
+    for name, clause in SEARCH_FILTERS.items():
+        value = filters.get(name)
+        if value is None:
+            continue
+        if name in ('start', 'end'):
+            check_timestamp(name, value)
+        if name == 'metadata':
+            try:
+                value = json.dumps(json.loads(value) if isinstance(value, str) else value)
+            except ValueError:
+                raise QueryRejected("Invalid metadata JSON: {}".format(value))
+        clauses.append(clause)
+        if name == 'q':
+            params.extend([Config.FTS_CONFIG, value])
+        else:
+            params.append(value)
+
+    if not clauses:
+        raise QueryRejected("At least one filter is required")
+
+    text_query = filters.get('q')
+    if sort == 'rank' and text_query is None:
+        raise QueryRejected("sort=rank requires q")
+    if sort == 'rank' and cursor:
+        raise QueryRejected("sort=rank does not support cursors")
+
+    if cursor:
+        clauses.append("(m.origin_ts, m.message_uuid) > (%s::timestamptz, %s::uuid)")
+        params.extend(decode_cursor(cursor))
+
+    if text_query is not None:
+        query = (
+            "SELECT " + select_list(fields, 'm.') + ", "
+            "ts_rank(s.message_tsv, websearch_to_tsquery(%s::regconfig, %s)) AS rank "
+            "FROM message_exchange m JOIN message_search s "
+            "ON s.message_uuid = m.message_uuid AND s.origin_ts = m.origin_ts "
+        )
+        params = [Config.FTS_CONFIG, text_query] + params
+    else:
+        query = "SELECT " + select_list(fields, 'm.') + " FROM message_exchange m "
+    query += "WHERE " + " AND ".join(clauses)
+
+    if sort == 'rank':
+        query += " ORDER BY rank DESC, m.origin_ts, m.message_uuid"
+    else:
+        query += " ORDER BY m.origin_ts, m.message_uuid"
+    return query, params
+
+
+def build_subject_query(subject_id, cursor=None, fields=None):
+    # @> (rather than = ANY) lets the planner use the GIN index on the array
+    query = (
+        "SELECT " + select_list(fields) + " FROM message_exchange "
+        "WHERE (source_subject_id = %s OR destination_subject_ids @> ARRAY[%s]::text[])"
+    )
+    params = [subject_id, subject_id]
+    if cursor:
+        query += " AND (origin_ts, message_uuid) > (%s::timestamptz, %s::uuid)"
+        params.extend(decode_cursor(cursor))
+    query += " ORDER BY origin_ts, message_uuid"
+    return query, params
+
+
+def build_stats_query(bucket='1h', filters=None, limit=None, percentiles=True):
+    view = STATS_VIEWS.get(bucket)
+    if view is None:
+        raise QueryRejected("Unsupported bucket: {}".format(bucket))
+
+    clauses, params = [], []
+    for name, clause in STATS_FILTERS.items():
+        value = (filters or {}).get(name)
+        if value is not None:
+            if name in ('start', 'end'):
+                check_timestamp(name, value)
+            clauses.append(clause)
+            params.append(value)
+
+    query = "SELECT bucket, topic, message_type, source_subject_id, message_count, payload_bytes, "
+    if percentiles:
+        query += (
+            "approx_percentile(0.5, latency_ms) AS latency_p50_ms, "
+            "approx_percentile(0.95, latency_ms) AS latency_p95_ms, "
+            "approx_percentile(0.99, latency_ms) AS latency_p99_ms "
+        )
+    else:
+        # rollups built without timescaledb_toolkit
+        query += "NULL AS latency_p50_ms, NULL AS latency_p95_ms, NULL AS latency_p99_ms "
+    query += "FROM {view}".format(view=view)
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY bucket DESC, topic, message_type, source_subject_id LIMIT %s"
+    params.append(page_limit(limit))
+    return query, params
+
+
+def build_conversation_query(subject_a, subject_b, cursor=None, fields=None, start=None, end=None):
+    """
+    Builds the query for the messages exchanged between two subjects, in
+    either direction, in (origin_ts, message_uuid) order. The pair is
+    looked up in message_conversation, whose primary key serves both the
+    filter and the ordering.
+    """
+    if not subject_a or not subject_b:
+        raise QueryRejected("Both a and b are required")
+    for name, value in (('start', start), ('end', end)):
+        if value is not None:
+            check_timestamp(name, value)
+
+    query = (
+        "SELECT " + select_list(fields, 'm.') + " FROM message_conversation c "
+        "JOIN message_exchange m ON m.message_uuid = c.message_uuid AND m.origin_ts = c.origin_ts "
+        # ordered by the database, so the pair matches the trigger's collation
+        "WHERE c.subject_a = LEAST(%s::text, %s::text) AND c.subject_b = GREATEST(%s::text, %s::text)"
+    )
+    params = [subject_a, subject_b, subject_a, subject_b]
+    if start is not None:
+        query += " AND c.origin_ts >= %s::timestamptz"
+        params.append(start)
+    if end is not None:
+        query += " AND c.origin_ts < %s::timestamptz"
+        params.append(end)
+    if cursor:
+        query += " AND (c.origin_ts, c.message_uuid) > (%s::timestamptz, %s::uuid)"
+        params.extend(decode_cursor(cursor))
+    query += " ORDER BY c.origin_ts, c.message_uuid"
+    return query, params
@@ -1,17 +1,186 @@
+import uuid
+from datetime import datetime, timezone
+
 from .db import TimescaleDB
+from .cache import MessageCache
+from .archive import MessageArchive, pq
+from .config import Config
+from .queries import (
+    row_to_dict, encode_cursor, decode_cursor, build_search_query, build_subject_query,
+    build_stats_query, build_conversation_query, check_plan, project, page_limit, STATS_PERCENTILES_QUERY
+)
+
+
+def needs_archive(archive, filters, after):
+    """
+    Whether a time-ordered search page starts at or before the archive
+    watermark. Only searches with an explicit `start` reach into the archive,
+    so an open-ended search never scans cold objects.
+    """
+    # the archive holds neither the search index nor metadata indexes
+    if filters.get('q') is not None or filters.get('metadata') is not None:
+        return False
+    if filters.get('start') is None:
+        return False
+    watermark = archive.watermark()
+    if watermark is None:
+        return False
+    position = after[0] if after is not None else filters['start']
+    position = datetime.fromisoformat(position)
+    if position.tzinfo is None:
+        position = position.replace(tzinfo=timezone.utc)
+    return position <= watermark
+
 
 class ReadController:
-    def __init__(self):
-        self.db = TimescaleDB()
+    def __init__(self, db=None, cache=None, archive=None):
+        # the pool is shared, so every request checks out its own connection
+        # instead of sharing one transaction across Flask worker threads
+        self.db = db or TimescaleDB()
+        self.cache = cache or MessageCache()
+        if archive is None and Config.ARCHIVE_FALLBACK and pq is not None:
+            archive = MessageArchive(self.db)
+        self.archive = archive
+        self.stats_percentiles = None
 
     def get_message_by_uuid(self, message_uuid):
+        message = self.cache.get(message_uuid)
+        if message is not None:
+            return message
+
         query = "SELECT * FROM message_exchange WHERE message_uuid = %s"
-        with self.db.conn.cursor() as cur:
-            cur.execute(query, (message_uuid,))
-            return cur.fetchone()
-
-    def get_messages_by_subject(self, subject_id):
-        query = "SELECT * FROM message_exchange WHERE source_subject_id = %s OR %s = ANY(destination_subject_ids)"
-        with self.db.conn.cursor() as cur:
-            cur.execute(query, (subject_id, subject_id))
-            return cur.fetchall()
+        with self.db.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, (message_uuid,))
+                row = cur.fetchone()
+                if row is not None:
+                    message = row_to_dict([d.name for d in cur.description], row)
+
+        if message is None and self.archive is not None:
+            message = self.archive.get_message(message_uuid)
+        if message is None:
+            return None
+
+        self.cache.put(message)
+        return message
+
+    def _subject_query(self, subject_id, cursor=None, fields=None):
+        return build_subject_query(subject_id, cursor, fields)
+
+    def get_messages_by_subject(self, subject_id, limit=None, cursor=None, fields=None):
+        """
+        Returns one page of a subject's history in (origin_ts, message_uuid)
+        order, plus the cursor for the next page (None on the last page).
+        """
+        query, params = self._subject_query(subject_id, cursor, fields)
+        return self._page(query, params, limit)
+
+    def get_conversation(self, subject_a, subject_b, limit=None, cursor=None, fields=None, start=None, end=None):
+        """
+        Returns one page of the messages exchanged between two subjects, in
+        either direction, plus the cursor for the next page.
+        """
+        query, params = build_conversation_query(subject_a, subject_b, cursor, fields, start, end)
+        return self._page(query, params, limit)
+
+    def _page(self, query, params, limit=None):
+        limit = page_limit(limit)
+        query += " LIMIT %s"
+        params.append(limit + 1)
+
+        with self.db.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                rows = cur.fetchall()
+                columns = [d.name for d in cur.description]
+
+        messages = [row_to_dict(columns, row) for row in rows[:limit]]
+        next_cursor = encode_cursor(messages[-1]) if len(rows) > limit else None
+        return messages, next_cursor
+
+    def _check_plan(self, cur, query, params):
+        cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+        check_plan(cur.fetchone()[0][0]['Plan'])
+
+    def search_messages(self, filters, limit=None, cursor=None, sort='time', fields=None):
+        """
+        Returns one page of messages matching all of the given filters
+        (see SEARCH_FILTERS), plus the cursor for the next page. Archived
+        chunks always precede the hot table in time, so pages that start
+        before the archive watermark are served from the archive first and
+        topped up from Postgres.
+        """
+        limit = page_limit(limit)
+        # validates the filters and cursor before touching either tier
+        query, params = build_search_query(filters, cursor, sort=sort, fields=fields)
+
+        messages = []
+        if self.archive is not None and sort == 'time':
+            after = decode_cursor(cursor) if cursor else None
+            if needs_archive(self.archive, filters, after):
+                messages, resume = self.archive.search(filters, after=after, limit=limit + 1)
+                messages = [project(m, fields) for m in messages]
+                if len(messages) > limit:
+                    return messages[:limit], encode_cursor(messages[limit - 1])
+                if resume is not None:
+                    # the scan stopped at ARCHIVE_SEARCH_MAX_OBJECTS; a short page
+                    # continues in the archive on the next request
+                    return messages, encode_cursor({'origin_ts': resume[0], 'message_uuid': resume[1]})
+                if messages:
+                    query, params = build_search_query(filters, encode_cursor(messages[-1]), fields=fields)
+
+        query += " LIMIT %s"
+        params.append(limit + 1 - len(messages))
+
+        with self.db.connection() as conn:
+            with conn.cursor() as cur:
+                if Config.SEARCH_PLAN_GUARD:
+                    self._check_plan(cur, query, params)
+                cur.execute(query, params)
+                rows = cur.fetchall()
+                columns = [d.name for d in cur.description]
+
+        messages.extend(row_to_dict(columns, row) for row in rows)
+        has_more = len(messages) > limit and sort == 'time'
+        next_cursor = encode_cursor(messages[limit - 1]) if has_more else None
+        return messages[:limit], next_cursor
+
+    def get_stats(self, bucket='1h', filters=None, limit=None):
+        """
+        Reads per topic/message_type/source rollups from the continuous
+        aggregates: message counts, payload bytes and latency percentiles.
+        """
+        with self.db.connection() as conn:
+            with conn.cursor() as cur:
+                if self.stats_percentiles is None:
+                    cur.execute(STATS_PERCENTILES_QUERY)
+                    self.stats_percentiles = cur.fetchone() is not None
+                query, params = build_stats_query(bucket, filters, limit, self.stats_percentiles)
+                cur.execute(query, params)
+                columns = [d.name for d in cur.description]
+                return [row_to_dict(columns, row) for row in cur.fetchall()]
+
+    def stream_messages_by_subject(self, subject_id, cursor=None, fields=None):
+        query, params = self._subject_query(subject_id, cursor, fields)
+        return self._stream(query, params)
+
+    def _stream(self, query, params):
+        """
+        Yields rows through a server-side cursor, holding at most
+        STREAM_FETCH_SIZE rows in memory at a time.
+        """
+        with self.db.connection() as conn:
+            with conn.cursor(name='stream_{}'.format(uuid.uuid4().hex)) as cur:
+                cur.itersize = Config.STREAM_FETCH_SIZE
+                cur.execute(query, params)
+                columns = None
+                for row in cur:
+                    if columns is None:
+                        columns = [d.name for d in cur.description]
+                    yield row_to_dict(columns, row)
+
+    def pool_stats(self):
+        return self.db.pool.stats()
+
+    def cache_stats(self):
+        return self.cache.stats()
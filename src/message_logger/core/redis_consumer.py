@@ -1,48 +1,462 @@
+import psycopg2
 import redis
+import socket
 import threading
 import time
 import json
-from .db import TimescaleDB
+import logging
+import uuid
+from .backfill import run_backfills
+from .db import TimescaleDB, parse_timestamp
+from .pool import DBPool
+from .cache import MessageCache, record_to_message
+from .sampling import Sampler
 from .config import Config
 
+logger = logging.getLogger(__name__)
+
+
+def shard_queues(shards=None):
+    # shard 0 keeps the original list name so unsharded producers still work
+    shards = shards or Config.REDIS_SHARDS
+    return [Config.REDIS_QUEUE] + ['{}:{}'.format(Config.REDIS_QUEUE, i) for i in range(1, shards)]
+
+
+def processing_queue(worker_id):
+    return '{}:processing:{}'.format(Config.REDIS_QUEUE, worker_id)
+
+
+def heartbeat_key(worker_id):
+    return '{}:heartbeat:{}'.format(Config.REDIS_QUEUE, worker_id)
+
+
+def requeue(redis_conn, source, destination):
+    """
+    Moves every entry of `source` back to the head of `destination`, one
+    atomic LMOVE at a time, newest first so the oldest end up consumed first.
+    """
+    moved = 0
+    while redis_conn.lmove(source, destination, 'RIGHT', 'LEFT') is not None:
+        moved += 1
+    return moved
+
+
+def recover_orphans(redis_conn, queue=None):
+    """
+    Returns the in-flight messages of consumers whose heartbeat has expired
+    to the main queue. Inserts are idempotent, so a batch that was written
+    but not yet acknowledged is harmlessly written again. Processing lists
+    are found by key as well as through the stats hash, so lists left by a
+    worker id that never comes back (a new hostname) are recovered too.
+    """
+    queue = queue or Config.REDIS_QUEUE
+    prefix = processing_queue('')
+    worker_ids = set(redis_conn.hkeys(Config.CONSUMER_STATS_KEY))
+    worker_ids.update(key[len(prefix):] for key in redis_conn.scan_iter(match=processing_queue('*')))
+    recovered = 0
+    for worker_id in sorted(worker_ids):
+        if redis_conn.exists(heartbeat_key(worker_id)):
+            continue
+        moved = requeue(redis_conn, processing_queue(worker_id), queue)
+        if moved:
+            logger.warning(f"Recovered {moved} unacknowledged messages from consumer {worker_id}")
+        recovered += moved
+        redis_conn.hdel(Config.CONSUMER_STATS_KEY, worker_id)
+    return recovered
+
+
+def bisect_rejects(rows, write):
+    """
+    Writes `rows` with `write`, splitting around rows the database rejects
+    on their data, or that cannot be serialised for it (ValueError and
+    TypeError raised client-side); returns the indexes of the rejected rows.
+    Any other error (connection, timeout) propagates.
+    """
+    rejected = []
+
+    def attempt(lo, hi):
+        try:
+            write(rows[lo:hi])
+        except (psycopg2.DataError, psycopg2.IntegrityError, ValueError, TypeError) as e:
+            if hi - lo == 1:
+                logger.error(f"Row rejected by the database: {e}")
+                rejected.append(lo)
+                return
+            mid = (lo + hi) // 2
+            attempt(lo, mid)
+            attempt(mid, hi)
+
+    attempt(0, len(rows))
+    return rejected
+
+
+def _text(data, name):
+    value = data[name]
+    if value is not None and not isinstance(value, str):
+        raise TypeError(f"{name} must be a string")
+    if value is not None:
+        # lone surrogates survive json.loads but cannot be sent to Postgres
+        value.encode('utf-8')
+    return value
+
+
+def _timestamp(data, name):
+    value = data[name]
+    if value is None:
+        return None
+    try:
+        return parse_timestamp(value)
+    except (OverflowError, OSError) as e:
+        raise ValueError(f"{name} is out of range: {e}")
+
+
+def check_heartbeat_ttl():
+    """
+    Raises ValueError unless CONSUMER_HEARTBEAT_TTL is at least twice the
+    sum of BATCH_INTERVAL and the statement timeout; a live worker that outlives
+    its heartbeat has its in-flight batch requeued and written twice.
+    """
+    flush_window = Config.BATCH_INTERVAL + Config.DB_STATEMENT_TIMEOUT_MS / 1000
+    if Config.CONSUMER_HEARTBEAT_TTL < 2 * flush_window:
+        raise ValueError(
+            f"CONSUMER_HEARTBEAT_TTL ({Config.CONSUMER_HEARTBEAT_TTL}s) must be at least twice "
+            f"BATCH_INTERVAL + DB_STATEMENT_TIMEOUT_MS ({flush_window:g}s)"
+        )
+
+
+def consumer_lag(redis_conn, queues=None):
+    """Queue depth per shard plus the last stats reported by every worker."""
+    queues = queues or shard_queues()
+    pipe = redis_conn.pipeline(transaction=False)
+    for queue in queues:
+        pipe.llen(queue)
+    lengths = pipe.execute()
+    workers = redis_conn.hgetall(Config.CONSUMER_STATS_KEY)
+    return {
+        'queues': dict(zip(queues, lengths)),
+        'workers': [json.loads(stats) for _, stats in sorted(workers.items())]
+    }
+
+
 class RedisConsumer:
-    def __init__(self):
-        self.db = TimescaleDB()
+    def __init__(self, worker_id=None, queues=None, db=None):
+        self.worker_id = worker_id or '{}-0'.format(socket.gethostname())
+        self.queues = queues or [Config.REDIS_QUEUE]
+        self.db = db or TimescaleDB()
         self.redis_conn = redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, decode_responses=True)
+        self.processing_queue = processing_queue(self.worker_id)
+        self.next_queue = 0
         self.messages = []
+        # the raw entries of self.messages, for dead-lettering rejected rows
+        self.raw_messages = []
+        # entries in the processing list, including ones the sampler dropped
+        self.pending = 0
+        self.sampler = Sampler(self.redis_conn)
+        self.stopped = threading.Event()
+        # the writer only warms the shared Redis tier; its own LRU is never read
+        self.cache = MessageCache() if Config.CACHE_WARM_ON_WRITE and Config.CACHE_REDIS_ENABLED else None
+
+        self.last_write_time = time.time()
+        self.last_report_time = 0.0
+        self.oldest_buffered_at = None
+        self.flushes = 0
+        self.written = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.rejected = 0
+        self.last_flush_size = 0
+        self.last_flush_seconds = 0.0
+        self.flush_seconds_total = 0.0
 
     def process_message(self, message):
-        # Process the message into a tuple
+        # Process the message into a tuple. Values are converted here, so a
+        # malformed envelope is dead-lettered by the caller instead of failing
+        # the whole batch when it is serialised for the database.
         data = json.loads(message)
+        if not isinstance(data, dict):
+            raise ValueError("Message is not a JSON object")
+        destinations = data['destination_subject_ids']
+        if destinations is not None and (
+                not isinstance(destinations, list) or not all(isinstance(d, str) for d in destinations)):
+            raise TypeError("destination_subject_ids must be a list of strings")
+        for destination in destinations or ():
+            destination.encode('utf-8')
+        origin_ts = _timestamp(data, 'origin_ts')
+        if origin_ts is None:
+            raise ValueError("origin_ts is required")
         return (
-            data['message_uuid'],
-            data['origin_ts'],
-            data['ack_ts'],
+            str(uuid.UUID(str(data['message_uuid']))),
+            origin_ts,
+            _timestamp(data, 'ack_ts'),
             json.dumps(data['message_data']),
-            data['source_subject_id'],
-            data['destination_subject_ids'],
-            data['topic'],
-            data['message_type'],
+            _text(data, 'source_subject_id'),
+            destinations,
+            _text(data, 'topic'),
+            _text(data, 'message_type'),
             json.dumps(data['message_metadata'])
         )
 
+    def should_flush(self):
+        if self.pending >= Config.BATCH_SIZE:
+            return True
+        return bool(self.pending) and time.time() - self.last_write_time >= Config.BATCH_INTERVAL
+
     def batch_write(self):
-        while True:
-            if len(self.messages) >= Config.BATCH_SIZE or (self.messages and time.time() - self.last_write_time >= Config.BATCH_INTERVAL):
+        started = time.monotonic()
+        counts = self.sampler.drain_counts()
+        try:
+            if self.messages and self.consecutive_failures >= Config.CONSUMER_MAX_RETRIES:
+                self.write_isolating_rejects()
+            elif self.messages:
                 self.db.batch_insert(self.messages)
-                self.messages = []
-                self.last_write_time = time.time()
+            if counts and self.consecutive_failures >= Config.CONSUMER_MAX_RETRIES:
+                rejected = bisect_rejects(counts, self.db.upsert_sampled_counts)
+                if rejected:
+                    logger.error(f"Consumer {self.worker_id} discarded {len(rejected)} uncountable sampled messages")
+            elif counts:
+                self.db.upsert_sampled_counts(counts)
+        except Exception as e:
+            # keep the buffer (and the processing list) and retry on the next pass;
+            # retried inserts and counts are no-ops for rows already written
+            self.sampler.restore_counts(counts)
+            self.failures += 1
+            self.consecutive_failures += 1
+            logger.error(f"Consumer {self.worker_id} failed to write batch of {len(self.messages)}: {e}")
+            self.report()
+            time.sleep(Config.CONSUMER_RETRY_BACKOFF)
+            return
+
+        # acknowledge only after the commit: the processing list holds exactly
+        # the buffered batch, so dropping it acks every message at once
+        self.redis_conn.delete(self.processing_queue)
+        self.consecutive_failures = 0
+
+        if self.cache is not None:
+            try:
+                self.cache.warm([record_to_message(m) for m in self.messages], local=False)
+            except Exception as e:
+                logger.warning(f"Failed to warm message cache: {e}")
+
+        elapsed = time.monotonic() - started
+        self.flushes += 1
+        self.written += len(self.messages)
+        self.last_flush_size = len(self.messages)
+        self.last_flush_seconds = elapsed
+        self.flush_seconds_total += elapsed
+        self.messages = []
+        self.raw_messages = []
+        self.pending = 0
+        self.oldest_buffered_at = None
+        self.last_write_time = time.time()
+        self.report()
+
+    def write_isolating_rejects(self):
+        """
+        Bisects the buffer until every row Postgres rejects on its data is
+        isolated, writing the rest. Rejected rows go to the dead-letter
+        queue so one bad row cannot stall the batch forever; any other
+        error (connection, timeout) still fails the flush for a retry.
+        """
+        def write(rows):
+            # bisecting takes many statements, each up to the statement timeout
+            self.heartbeat()
+            self.db.batch_insert(rows)
+
+        rejected = bisect_rejects(self.messages, write)
+        if not rejected:
+            return
+        logger.error(f"Consumer {self.worker_id} dead-lettered {len(rejected)} rows rejected by the database")
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for i in rejected:
+            pipe.rpush(Config.DEAD_LETTER_QUEUE, self.raw_messages[i])
+        pipe.execute()
+        self.rejected += len(rejected)
+        rejected = set(rejected)
+        self.messages = [m for i, m in enumerate(self.messages) if i not in rejected]
+        self.raw_messages = [m for i, m in enumerate(self.raw_messages) if i not in rejected]
+
+    def stats(self):
+        return {
+            'worker_id': self.worker_id,
+            'queues': self.queues,
+            'buffered': len(self.messages),
+            'oldest_buffered_age': time.time() - self.oldest_buffered_at if self.oldest_buffered_at else 0.0,
+            'last_write_time': self.last_write_time,
+            'flushes': self.flushes,
+            'written': self.written,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'last_flush_size': self.last_flush_size,
+            'last_flush_seconds': self.last_flush_seconds,
+            'flush_seconds_total': self.flush_seconds_total,
+            'sampling': self.sampler.stats()
+        }
+
+    def report(self):
+        try:
+            pipe = self.redis_conn.pipeline(transaction=False)
+            pipe.hset(Config.CONSUMER_STATS_KEY, self.worker_id, json.dumps(self.stats()))
+            pipe.set(heartbeat_key(self.worker_id), int(time.time()), ex=Config.CONSUMER_HEARTBEAT_TTL)
+            pipe.execute()
+            self.last_report_time = time.monotonic()
+        except redis.RedisError as e:
+            logger.warning(f"Consumer {self.worker_id} failed to report stats: {e}")
+
+    def heartbeat(self):
+        """Reports, refreshing the heartbeat, once a third of its TTL has passed."""
+        if time.monotonic() - self.last_report_time >= Config.CONSUMER_HEARTBEAT_TTL / 3:
+            self.report()
+
+    def recover(self):
+        # a restarted worker reuses its id, so anything it left in flight is
+        # put back on the queue before it starts consuming again
+        moved = requeue(self.redis_conn, self.processing_queue, self.queues[0])
+        if moved:
+            logger.warning(f"Consumer {self.worker_id} requeued {moved} unacknowledged messages")
+
+    def fetch(self):
+        """
+        Moves up to the remaining batch capacity from the queues into this
+        consumer's processing list with pipelined LMOVEs, blocking briefly
+        only when every queue is empty.
+        """
+        wanted = Config.BATCH_SIZE - self.pending
+        if wanted <= 0:
+            # a failed flush is being retried; don't grow the batch meanwhile
+            return []
+        # producers RPUSH, so taking from the LEFT consumes oldest first
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for i in range(wanted):
+            queue = self.queues[(self.next_queue + i) % len(self.queues)]
+            pipe.lmove(queue, self.processing_queue, 'LEFT', 'RIGHT')
+        raw_messages = [m for m in pipe.execute() if m is not None]
+        self.next_queue = (self.next_queue + wanted) % len(self.queues)
+        if raw_messages:
+            return raw_messages
+
+        # the timeout lets BATCH_INTERVAL flushes happen on a quiet queue
+        queue = self.queues[self.next_queue]
+        self.next_queue = (self.next_queue + 1) % len(self.queues)
+        message = self.redis_conn.blmove(queue, self.processing_queue, 1, 'LEFT', 'RIGHT')
+        return [message] if message is not None else []
 
     def listen_to_redis(self):
+        self.recover()
         self.last_write_time = time.time()
-        while True:
-            message = self.redis_conn.brpop(Config.REDIS_QUEUE)
-            if message:
-                self.messages.append(self.process_message(message[1]))
+        while not self.stopped.is_set():
+            # a busy worker may go a while between flushes
+            self.heartbeat()
+            self.sampler.refresh()
+            raw_messages = self.fetch()
+            self.pending += len(raw_messages)
+            for raw in raw_messages:
+                try:
+                    record = self.process_message(raw)
+                    # policies apply before batching, so dropped messages never reach the writer
+                    keep = self.sampler.admit(record)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    # anything raised for one bad payload must not kill the worker
+                    logger.error(f"Consumer {self.worker_id} dead-lettered malformed message: {e}")
+                    self.redis_conn.rpush(Config.DEAD_LETTER_QUEUE, raw)
+                    continue
+                if not keep:
+                    continue
+                self.messages.append(record)
+                self.raw_messages.append(raw)
+                if self.oldest_buffered_at is None:
+                    self.oldest_buffered_at = time.time()
+            if not raw_messages and not self.pending:
+                self.report()
 
+            if self.should_flush():
+                self.batch_write()
+
+        # anything still buffered stays in the processing list if this fails
+        if self.pending:
             self.batch_write()
 
+    def stop(self):
+        """Makes listen_to_redis flush its buffer and return, within one fetch timeout."""
+        self.stopped.set()
+
+
+class ConsumerPool:
+    """
+    Runs `workers` RedisConsumer threads that together drain the (optionally
+    sharded) message queue. Each worker keeps its own batch buffer and, since
+    the writer pool is sized to the worker count, effectively its own
+    database connection.
+    """
+
+    def __init__(self, workers=None, queues=None):
+        check_heartbeat_ttl()
+        self.workers = workers or Config.CONSUMER_WORKERS
+        self.queues = queues or shard_queues()
+        self.db_pool = DBPool(minconn=self.workers, maxconn=self.workers)
+        self.consumers = []
+        self.threads = []
+        self.stopped = threading.Event()
+
+        hostname = socket.gethostname()
+        for i in range(self.workers):
+            # with at least as many shards as workers each shard has one owner;
+            # otherwise every worker drains every shard
+            if len(self.queues) >= self.workers:
+                queues = self.queues[i::self.workers]
+            else:
+                queues = self.queues
+            self.consumers.append(RedisConsumer(
+                worker_id='{}-{}'.format(hostname, i),
+                queues=queues,
+                db=TimescaleDB(pool=self.db_pool)
+            ))
+
+    def maintain(self):
+        # workers of another pod can die at any time, not just before this
+        # pool starts, so orphaned processing lists are looked for periodically
+        while not self.stopped.wait(Config.CONSUMER_RECOVERY_INTERVAL):
+            try:
+                recover_orphans(self.consumers[0].redis_conn, self.queues[0])
+            except redis.RedisError as e:
+                logger.warning(f"Failed to recover orphaned consumer messages: {e}")
+
+    def backfill(self):
+        # history that predates the side-table triggers is indexed in the
+        # background, so startup never waits on it
+        while not self.stopped.is_set():
+            try:
+                run_backfills(stopped=self.stopped)
+                return
+            except Exception as e:
+                logger.warning(f"Side table backfill interrupted, will resume: {e}")
+                self.stopped.wait(Config.CONSUMER_RECOVERY_INTERVAL)
+
+    def start(self):
+        for consumer in self.consumers:
+            consumer.report()
+        recover_orphans(self.consumers[0].redis_conn, self.queues[0])
+        for consumer in self.consumers:
+            thread = threading.Thread(target=consumer.listen_to_redis)
+            thread.start()
+            self.threads.append(thread)
+        threading.Thread(target=self.maintain, daemon=True).start()
+        threading.Thread(target=self.backfill, daemon=True).start()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def stop(self):
+        self.stopped.set()
+        for consumer in self.consumers:
+            consumer.stop()
+        self.join()
+
+    def stats(self):
+        return [consumer.stats() for consumer in self.consumers]
+
+
 def start_redis_consumer():
-    consumer = RedisConsumer()
-    consumer_thread = threading.Thread(target=consumer.listen_to_redis)
-    consumer_thread.start()
+    pool = ConsumerPool()
+    pool.start()
+    return pool
@@ -0,0 +1,280 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+
+from .config import Config
+from .db import TimescaleDB
+from .queries import build_search_query, encode_cursor, row_to_dict, SEARCH_FILTERS
+
+logger = logging.getLogger(__name__)
+
+REPLAY_TARGETS = ('nats', 'fanout')
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` messages per second with a burst of one second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class NatsPublisher:
+    def __init__(self, url=None):
+        self.url = url or Config.REPLAY_NATS_URL
+        self.connection = None
+
+    async def connect(self):
+        import nats
+
+        self.connection = await nats.connect(self.url)
+
+    async def publish(self, message, job_id):
+        await self.connection.publish(
+            message['topic'],
+            json.dumps(message).encode(),
+            headers={'Replay-Job': job_id}
+        )
+
+    async def close(self):
+        if self.connection is not None:
+            await self.connection.drain()
+
+
+class FanoutPublisher:
+    """Posts messages to the fanout HTTP receiver, which re-drives both NATS and the logger."""
+
+    def __init__(self, url=None):
+        self.url = (url or Config.REPLAY_FANOUT_URL).rstrip('/') + '/MESSAGES'
+        self.session = None
+
+    async def connect(self):
+        import aiohttp
+
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+
+    async def publish(self, message, job_id):
+        async with self.session.post(self.url, json={'message': json.dumps(message)}) as resp:
+            resp.raise_for_status()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class ReplayJob:
+    """
+    Re-publishes a filtered range of message_exchange in origin order.
+
+    Rows are read in REPLAY_CHUNK_ROWS chunks through a server-side cursor.
+    Each chunk is published with at most `concurrency` messages in flight
+    and at most `rate` messages per second, and the checkpoint is advanced
+    only once the whole chunk has been published, so a restarted job
+    resumes without skipping anything. Use concurrency=1 for strict order.
+    """
+
+    def __init__(self, db, job_id, filters=None, target='nats', rate=None, concurrency=None,
+                 dry_run=False, checkpoint_dir=None):
+        self.db = db
+        self.job_id = job_id
+        self.checkpoint_path = os.path.join(checkpoint_dir or Config.REPLAY_CHECKPOINT_DIR, job_id + '.json')
+
+        state = self.load_checkpoint(self.checkpoint_path)
+        if state is None:
+            if target not in REPLAY_TARGETS:
+                raise ValueError("Unsupported replay target: {}".format(target))
+            state = {
+                'job_id': job_id,
+                'filters': {k: v for k, v in (filters or {}).items() if k in SEARCH_FILTERS and k != 'q'},
+                'target': target,
+                'rate': rate if rate is not None else Config.REPLAY_RATE,
+                'concurrency': concurrency or Config.REPLAY_CONCURRENCY,
+                'dry_run': dry_run,
+                'status': 'pending',
+                'published': 0,
+                'failed': 0,
+                'topics': {},
+                'cursor': None,
+                'position': None,
+                'error': None,
+                'created_at': time.time(),
+                'updated_at': time.time()
+            }
+        self.state = state
+
+    @staticmethod
+    def load_checkpoint(path):
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def save_checkpoint(self):
+        self.state['updated_at'] = time.time()
+        os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def publisher(self):
+        if self.state['target'] == 'fanout':
+            return FanoutPublisher()
+        return NatsPublisher()
+
+    async def publish_chunk(self, publisher, limiter, messages):
+        semaphore = asyncio.Semaphore(self.state['concurrency'])
+        topics = Counter()
+
+        async def publish_one(message):
+            async with semaphore:
+                await limiter.acquire()
+                if publisher is not None:
+                    await publisher.publish(message, self.job_id)
+                topics[message['topic']] += 1
+
+        results = await asyncio.gather(*(publish_one(m) for m in messages), return_exceptions=True)
+        failures = [r for r in results if isinstance(r, Exception)]
+        for topic, count in topics.items():
+            self.state['topics'][topic] = self.state['topics'].get(topic, 0) + count
+        self.state['published'] += len(messages) - len(failures)
+        return failures
+
+    async def run_async(self):
+        if self.state['status'] == 'completed':
+            return self.state
+
+        loop = asyncio.get_running_loop()
+        limiter = RateLimiter(0 if self.state['dry_run'] else self.state['rate'])
+        publisher = None if self.state['dry_run'] else self.publisher()
+
+        self.state['status'] = 'running'
+        self.state['error'] = None
+        self.save_checkpoint()
+
+        query, params = build_search_query(self.state['filters'], self.state['cursor'])
+        try:
+            if publisher is not None:
+                await publisher.connect()
+            with self.db.connection() as conn:
+                with conn.cursor(name='replay_{}'.format(uuid.uuid4().hex)) as cur:
+                    await loop.run_in_executor(None, cur.execute, query, params)
+                    while True:
+                        rows = await loop.run_in_executor(None, cur.fetchmany, Config.REPLAY_CHUNK_ROWS)
+                        if not rows:
+                            break
+                        columns = [d.name for d in cur.description]
+                        messages = [row_to_dict(columns, row) for row in rows]
+
+                        failures = await self.publish_chunk(publisher, limiter, messages)
+                        if failures:
+                            self.state['failed'] += len(failures)
+                            raise failures[0]
+
+                        self.state['cursor'] = encode_cursor(messages[-1])
+                        self.state['position'] = messages[-1]['origin_ts']
+                        self.save_checkpoint()
+
+            self.state['status'] = 'completed'
+        except Exception as e:
+            logger.error(f"Replay {self.job_id} stopped after {self.state['published']} messages: {e}")
+            self.state['status'] = 'failed'
+            self.state['error'] = str(e)
+        finally:
+            if publisher is not None:
+                await publisher.close()
+        self.save_checkpoint()
+        return self.state
+
+    def run(self):
+        return asyncio.run(self.run_async())
+
+
+class ReplayManager:
+    def __init__(self, db, checkpoint_dir=None):
+        self.db = db
+        self.checkpoint_dir = checkpoint_dir or Config.REPLAY_CHECKPOINT_DIR
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def _run_in_background(self, job):
+        with self.lock:
+            running = self.threads.get(job.job_id)
+            if running is not None and running.is_alive():
+                return
+            thread = threading.Thread(target=job.run, daemon=True)
+            self.threads[job.job_id] = thread
+            thread.start()
+
+    def start(self, filters, target='nats', rate=None, concurrency=None, dry_run=False):
+        # validate the filters before handing the job to a thread
+        build_search_query({k: v for k, v in filters.items() if k in SEARCH_FILTERS and k != 'q'})
+        job = ReplayJob(
+            self.db, uuid.uuid4().hex, filters=filters, target=target, rate=rate,
+            concurrency=concurrency, dry_run=dry_run, checkpoint_dir=self.checkpoint_dir
+        )
+        job.save_checkpoint()
+        self._run_in_background(job)
+        return job.state
+
+    def resume(self, job_id):
+        state = self.status(job_id)
+        if state is None:
+            return None
+        job = ReplayJob(self.db, state['job_id'], checkpoint_dir=self.checkpoint_dir)
+        self._run_in_background(job)
+        return job.state
+
+    def status(self, job_id):
+        try:
+            job_id = uuid.UUID(job_id).hex
+        except ValueError:
+            return None
+        return ReplayJob.load_checkpoint(os.path.join(self.checkpoint_dir, job_id + '.json'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-publish logged messages in origin order.")
+    for name in SEARCH_FILTERS:
+        if name != 'q':
+            parser.add_argument('--' + name.replace('_', '-'), dest=name)
+    parser.add_argument('--target', choices=REPLAY_TARGETS, default='nats')
+    parser.add_argument('--rate', type=float, default=Config.REPLAY_RATE, help="messages per second, 0 for unlimited")
+    parser.add_argument('--concurrency', type=int, default=Config.REPLAY_CONCURRENCY)
+    parser.add_argument('--job-id', help="resume the checkpointed job with this id")
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    filters = {name: getattr(args, name) for name in SEARCH_FILTERS if getattr(args, name, None) is not None}
+    job = ReplayJob(
+        TimescaleDB(), args.job_id or uuid.uuid4().hex, filters=filters, target=args.target,
+        rate=args.rate, concurrency=args.concurrency, dry_run=args.dry_run
+    )
+    state = job.run()
+    print(json.dumps(state, indent=2))
+
+
+if __name__ == '__main__':
+    main()
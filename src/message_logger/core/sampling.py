@@ -0,0 +1,177 @@
+import json
+import logging
+import time
+from collections import defaultdict
+
+import redis
+from .config import Config
+from .db import MESSAGE_COLUMNS, parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_MODES = ('all', 'every_n', 'first_per_window', 'count_only')
+
+TOPIC_INDEX = MESSAGE_COLUMNS.index('topic')
+ORIGIN_TS_INDEX = MESSAGE_COLUMNS.index('origin_ts')
+MESSAGE_UUID_INDEX = MESSAGE_COLUMNS.index('message_uuid')
+MESSAGE_TYPE_INDEX = MESSAGE_COLUMNS.index('message_type')
+SOURCE_INDEX = MESSAGE_COLUMNS.index('source_subject_id')
+METADATA_INDEX = MESSAGE_COLUMNS.index('message_metadata')
+
+
+class InvalidPolicy(ValueError):
+    pass
+
+
+def parse_policy(policy):
+    """
+    Validates a policy dict and fills in its defaults:
+
+        {"mode": "all"}
+        {"mode": "every_n", "n": 10}
+        {"mode": "first_per_window", "key": "source_subject_id", "window": 60}
+        {"mode": "count_only", "window": 60}
+
+    `key` is an envelope column or `message_metadata.<name>`; `window` is in
+    seconds and also sets the bucket that dropped messages are counted in.
+    """
+    if not isinstance(policy, dict):
+        raise InvalidPolicy("Policy must be an object")
+    mode = policy.get('mode', 'all')
+    if mode not in SAMPLING_MODES:
+        raise InvalidPolicy("Unsupported sampling mode: {}".format(mode))
+
+    parsed = {'mode': mode, 'window': policy.get('window', Config.SAMPLING_WINDOW)}
+    if mode == 'every_n':
+        parsed['n'] = policy.get('n')
+        if not isinstance(parsed['n'], int) or parsed['n'] < 1:
+            raise InvalidPolicy("every_n requires a positive integer n")
+    if mode == 'first_per_window':
+        parsed['key'] = policy.get('key', 'source_subject_id')
+        if not isinstance(parsed['key'], str) or (
+                parsed['key'] not in MESSAGE_COLUMNS and not parsed['key'].startswith('message_metadata.')):
+            raise InvalidPolicy("Unknown key: {}".format(parsed['key']))
+    if not isinstance(parsed['window'], (int, float)) or parsed['window'] <= 0:
+        raise InvalidPolicy("window must be a positive number of seconds")
+    return parsed
+
+
+def load_policies(redis_conn):
+    """SAMPLING_POLICIES from the environment, overridden per topic by the Redis hash."""
+    raw = dict(json.loads(Config.SAMPLING_POLICIES) if Config.SAMPLING_POLICIES else {})
+    for topic, policy in redis_conn.hgetall(Config.SAMPLING_POLICIES_KEY).items():
+        raw[topic] = json.loads(policy)
+
+    policies = {}
+    for topic, policy in raw.items():
+        try:
+            policies[topic] = parse_policy(policy)
+        except InvalidPolicy as e:
+            logger.error(f"Ignoring sampling policy for topic {topic}: {e}")
+    return policies
+
+
+def set_policy(redis_conn, topic, policy):
+    policy = parse_policy(policy)
+    redis_conn.hset(Config.SAMPLING_POLICIES_KEY, topic, json.dumps(policy))
+    return policy
+
+
+def delete_policy(redis_conn, topic):
+    return bool(redis_conn.hdel(Config.SAMPLING_POLICIES_KEY, topic))
+
+
+class Sampler:
+    """
+    Decides, per consumer, which records of a sampled topic are persisted.
+    Topics without a policy are always kept and not tracked. Every dropped
+    record is remembered with its window bucket, topic, message_type,
+    source and message id, so its count can be written alongside the batch
+    exactly once even if the batch is redelivered.
+
+    State is per consumer: with several workers a 1-in-N topic keeps about
+    one in N overall, and first_per_window may keep up to one message per
+    key per worker.
+    """
+
+    def __init__(self, redis_conn):
+        self.redis_conn = redis_conn
+        self.policies = {}
+        self.loaded_at = 0.0
+        self.seen = defaultdict(int)
+        self.windows = {}
+        self.dropped_rows = []
+        self.kept = defaultdict(int)
+        self.dropped = defaultdict(int)
+
+    def refresh(self):
+        if time.monotonic() - self.loaded_at < Config.SAMPLING_REFRESH_INTERVAL:
+            return
+        try:
+            self.policies = load_policies(self.redis_conn)
+        except (redis.RedisError, ValueError) as e:
+            logger.warning(f"Failed to reload sampling policies, keeping the previous ones: {e}")
+        self.loaded_at = time.monotonic()
+
+    def _key(self, record, key):
+        if key.startswith('message_metadata.'):
+            metadata = record[METADATA_INDEX]
+            metadata = json.loads(metadata) if isinstance(metadata, str) else metadata
+            value = (metadata or {}).get(key.split('.', 1)[1])
+        else:
+            value = record[MESSAGE_COLUMNS.index(key)]
+        return json.dumps(value, sort_keys=True) if isinstance(value, (dict, list)) else value
+
+    def admit(self, record):
+        """Whether the record should be persisted; dropped records are counted."""
+        topic = record[TOPIC_INDEX]
+        policy = self.policies.get(topic)
+        if policy is None:
+            return True
+
+        mode = policy['mode']
+        bucket = int(parse_timestamp(record[ORIGIN_TS_INDEX]).timestamp() // policy['window'] * policy['window'])
+        if mode == 'all':
+            keep = True
+        elif mode == 'every_n':
+            keep = self.seen[topic] % policy['n'] == 0
+            self.seen[topic] += 1
+        elif mode == 'first_per_window':
+            window_key = (topic, self._key(record, policy['key']))
+            keep = self.windows.get(window_key) != bucket
+            if keep:
+                self.windows[window_key] = bucket
+        else:
+            keep = False
+
+        if keep:
+            self.kept[topic] += 1
+        else:
+            self.dropped[topic] += 1
+            self.dropped_rows.append((
+                bucket, topic, record[MESSAGE_TYPE_INDEX] or '', record[SOURCE_INDEX] or '', mode,
+                record[MESSAGE_UUID_INDEX], record[ORIGIN_TS_INDEX]
+            ))
+        return keep
+
+    def drain_counts(self):
+        """Returns the pending dropped-message rows and forgets them."""
+        rows, self.dropped_rows = self.dropped_rows, []
+        # keys whose window has passed can no longer suppress anything
+        horizon = time.time() - Config.SAMPLING_WINDOW_STATE_TTL
+        self.windows = {k: v for k, v in self.windows.items() if v >= horizon}
+        return rows
+
+    def restore_counts(self, rows):
+        """Puts back rows that could not be written, so the next flush retries them."""
+        self.dropped_rows = rows + self.dropped_rows
+
+    def stats(self):
+        return {
+            topic: {
+                'policy': self.policies[topic]['mode'] if topic in self.policies else 'removed',
+                'kept': self.kept[topic],
+                'dropped': self.dropped[topic]
+            }
+            for topic in set(self.kept) | set(self.dropped)
+        }
@@ -0,0 +1,441 @@
+import logging
+from collections import namedtuple
+
+from .config import Config
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock key, so concurrent writers/API pods migrate one at a time
+MIGRATION_LOCK_ID = 7426001
+
+Migration = namedtuple('Migration', ['version', 'name', 'steps', 'autocommit'])
+
+
+def _is_hypertable(cur, table):
+    cur.execute(
+        "SELECT 1 FROM timescaledb_information.hypertables WHERE hypertable_name = %s",
+        (table,)
+    )
+    return cur.fetchone() is not None
+
+
+def _convert_to_hypertable(cur):
+    if _is_hypertable(cur, 'message_exchange'):
+        return
+
+    # hypertable unique constraints must include the partitioning column,
+    # so the UUID-only primary key becomes (message_uuid, origin_ts)
+    cur.execute(
+        "UPDATE message_exchange SET origin_ts = COALESCE(ack_ts, to_timestamp(0)) "
+        "WHERE origin_ts IS NULL"
+    )
+    cur.execute("ALTER TABLE message_exchange DROP CONSTRAINT IF EXISTS message_exchange_pkey")
+    cur.execute("ALTER TABLE message_exchange ALTER COLUMN origin_ts SET NOT NULL")
+    cur.execute("ALTER TABLE message_exchange ADD PRIMARY KEY (message_uuid, origin_ts)")
+    cur.execute(
+        "SELECT create_hypertable('message_exchange', 'origin_ts', "
+        "chunk_time_interval => %s::interval, migrate_data => true, if_not_exists => true)",
+        (Config.CHUNK_TIME_INTERVAL,)
+    )
+
+
+def _create_search_hypertable(cur):
+    _create_side_hypertable(cur, 'message_search')
+
+
+def _create_conversation_hypertable(cur):
+    _create_side_hypertable(cur, 'message_conversation')
+
+
+def _create_sampled_counts_hypertable(cur):
+    _create_side_hypertable(cur, 'message_sampled_counts', 'bucket')
+
+
+def _create_sampled_ids_hypertable(cur):
+    _create_side_hypertable(cur, 'message_sampled_ids')
+
+
+def _create_side_hypertable(cur, table, time_column='origin_ts'):
+    # side tables share message_exchange's chunk interval, so archival and
+    # retention can drop their chunks with the same time bounds
+    cur.execute(
+        "SELECT create_hypertable(%s, %s, "
+        "chunk_time_interval => %s::interval, migrate_data => true, if_not_exists => true)",
+        (table, time_column, Config.CHUNK_TIME_INTERVAL)
+    )
+
+
+def _convert_archive_index(cur):
+    if _is_hypertable(cur, 'message_archive_index'):
+        return
+    # as in migration 2, the unique key must include the partitioning column
+    cur.execute("ALTER TABLE message_archive_index DROP CONSTRAINT IF EXISTS message_archive_index_pkey")
+    cur.execute("ALTER TABLE message_archive_index ADD PRIMARY KEY (message_uuid, origin_ts)")
+    _create_side_hypertable(cur, 'message_archive_index')
+
+
+def _create_stats_aggregates(cur):
+    # latency percentiles are kept as toolkit sketches so the hourly view can
+    # roll the minute view up instead of rescanning message_exchange; without
+    # the toolkit the views keep counts and bytes only. Installing it later
+    # needs the views dropped and this migration re-applied.
+    cur.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'timescaledb_toolkit'")
+    toolkit = cur.fetchone() is not None
+    if toolkit:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS timescaledb_toolkit")
+    else:
+        logger.warning("timescaledb_toolkit is not available; /stats will not report latency percentiles")
+
+    cur.execute(
+        """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS message_stats_1m
+        WITH (timescaledb.continuous) AS
+        SELECT time_bucket(INTERVAL '1 minute', origin_ts) AS bucket,
+               topic,
+               message_type,
+               source_subject_id,
+               count(*) AS message_count,
+               sum(octet_length(message_data::text)) AS payload_bytes{latency}
+        FROM message_exchange
+        GROUP BY time_bucket(INTERVAL '1 minute', origin_ts), topic, message_type, source_subject_id
+        WITH NO DATA
+        """.format(latency=(
+            ",\n               percentile_agg(EXTRACT(EPOCH FROM (ack_ts - origin_ts)) * 1000) AS latency_ms"
+            if toolkit else ""
+        ))
+    )
+    cur.execute(
+        """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS message_stats_1h
+        WITH (timescaledb.continuous) AS
+        SELECT time_bucket(INTERVAL '1 hour', bucket) AS bucket,
+               topic,
+               message_type,
+               source_subject_id,
+               sum(message_count)::BIGINT AS message_count,
+               sum(payload_bytes)::BIGINT AS payload_bytes{latency}
+        FROM message_stats_1m
+        GROUP BY time_bucket(INTERVAL '1 hour', bucket), topic, message_type, source_subject_id
+        WITH NO DATA
+        """.format(latency=",\n               rollup(latency_ms) AS latency_ms" if toolkit else "")
+    )
+
+
+def _queue_backfill(cur, name):
+    # the history that predates a trigger is indexed by core.backfill in
+    # committed batches, rather than in one transaction holding the migration lock
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_backfills (
+            name TEXT PRIMARY KEY,
+            position TIMESTAMPTZ,
+            completed_at TIMESTAMPTZ
+        )
+        """
+    )
+    cur.execute("INSERT INTO schema_backfills (name) VALUES (%s) ON CONFLICT DO NOTHING", (name,))
+
+
+def _create_search_trigger(cur):
+    cur.execute(
+        """
+        CREATE OR REPLACE FUNCTION message_search_index() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO message_search (message_uuid, origin_ts, message_tsv)
+            VALUES (
+                NEW.message_uuid,
+                NEW.origin_ts,
+                jsonb_to_tsvector(%s::regconfig, COALESCE(NEW.message_data, '{}'::jsonb), '["string"]')
+            )
+            ON CONFLICT DO NOTHING;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        (Config.FTS_CONFIG,)
+    )
+    cur.execute("DROP TRIGGER IF EXISTS message_search_index ON message_exchange")
+    cur.execute(
+        "CREATE TRIGGER message_search_index AFTER INSERT ON message_exchange "
+        "FOR EACH ROW EXECUTE FUNCTION message_search_index()"
+    )
+    _queue_backfill(cur, 'message_search')
+
+
+def _create_conversation_trigger(cur):
+    # pairs are unordered: the lower subject id is always subject_a
+    cur.execute(
+        """
+        CREATE OR REPLACE FUNCTION message_conversation_index() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO message_conversation (subject_a, subject_b, origin_ts, message_uuid)
+            SELECT DISTINCT LEAST(NEW.source_subject_id, d), GREATEST(NEW.source_subject_id, d),
+                   NEW.origin_ts, NEW.message_uuid
+            FROM unnest(NEW.destination_subject_ids) AS d
+            WHERE NEW.source_subject_id IS NOT NULL AND d IS NOT NULL
+            ON CONFLICT DO NOTHING;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    cur.execute("DROP TRIGGER IF EXISTS message_conversation_index ON message_exchange")
+    cur.execute(
+        "CREATE TRIGGER message_conversation_index AFTER INSERT ON message_exchange "
+        "FOR EACH ROW EXECUTE FUNCTION message_conversation_index()"
+    )
+    _queue_backfill(cur, 'message_conversation')
+
+
+MIGRATIONS = [
+    Migration(1, 'create message_exchange', [
+        """
+        CREATE TABLE IF NOT EXISTS message_exchange (
+            message_uuid UUID PRIMARY KEY,
+            origin_ts TIMESTAMPTZ,
+            ack_ts TIMESTAMPTZ,
+            message_data JSONB,
+            source_subject_id TEXT,
+            destination_subject_ids TEXT[],
+            topic TEXT,
+            message_type TEXT,
+            message_metadata JSONB
+        )
+        """
+    ], False),
+    Migration(2, 'convert message_exchange to a hypertable on origin_ts', [
+        "CREATE EXTENSION IF NOT EXISTS timescaledb",
+        _convert_to_hypertable
+    ], False),
+    # built one chunk per transaction so existing deployments are not locked
+    # for the whole build; this cannot run inside a transaction block
+    Migration(3, 'subject lookup indexes', [
+        "CREATE INDEX IF NOT EXISTS message_exchange_source_subject_idx "
+        "ON message_exchange (source_subject_id, origin_ts DESC) "
+        "WITH (timescaledb.transaction_per_chunk)",
+        "CREATE INDEX IF NOT EXISTS message_exchange_destination_subjects_idx "
+        "ON message_exchange USING GIN (destination_subject_ids) "
+        "WITH (timescaledb.transaction_per_chunk)"
+    ], True),
+    Migration(4, 'enable native compression', [
+        "ALTER TABLE message_exchange SET ("
+        "timescaledb.compress, "
+        "timescaledb.compress_segmentby = 'topic', "
+        "timescaledb.compress_orderby = 'origin_ts DESC, message_uuid')"
+    ], False),
+    Migration(5, 'search filter indexes', [
+        "CREATE INDEX IF NOT EXISTS message_exchange_topic_idx "
+        "ON message_exchange (topic, origin_ts DESC) "
+        "WITH (timescaledb.transaction_per_chunk)",
+        "CREATE INDEX IF NOT EXISTS message_exchange_message_type_idx "
+        "ON message_exchange (message_type, origin_ts DESC) "
+        "WITH (timescaledb.transaction_per_chunk)",
+        "CREATE INDEX IF NOT EXISTS message_exchange_topic_message_type_idx "
+        "ON message_exchange (topic, message_type, origin_ts DESC) "
+        "WITH (timescaledb.transaction_per_chunk)"
+    ], True),
+    # continuous aggregates cannot be created inside a transaction block
+    Migration(6, 'per-topic throughput rollups', [
+        _create_stats_aggregates,
+        "SELECT add_continuous_aggregate_policy('message_stats_1m', "
+        "start_offset => INTERVAL '1 hour', end_offset => INTERVAL '1 minute', "
+        "schedule_interval => INTERVAL '1 minute', if_not_exists => true)",
+        "SELECT add_continuous_aggregate_policy('message_stats_1h', "
+        "start_offset => INTERVAL '3 days', end_offset => INTERVAL '1 hour', "
+        "schedule_interval => INTERVAL '1 hour', if_not_exists => true)"
+    ], True),
+    Migration(7, 'cold-tier archive manifest', [
+        """
+        CREATE TABLE IF NOT EXISTS message_archive_manifest (
+            object_key TEXT PRIMARY KEY,
+            chunk_name TEXT NOT NULL,
+            range_start TIMESTAMPTZ NOT NULL,
+            range_end TIMESTAMPTZ NOT NULL,
+            row_count BIGINT NOT NULL,
+            archived_at TIMESTAMPTZ DEFAULT now()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS message_archive_manifest_range_idx "
+        "ON message_archive_manifest (range_start, range_end)",
+        """
+        CREATE TABLE IF NOT EXISTS message_archive_index (
+            message_uuid UUID PRIMARY KEY,
+            origin_ts TIMESTAMPTZ NOT NULL,
+            object_key TEXT NOT NULL
+        )
+        """
+    ], False),
+    # the search vectors live in a side table filled by a row trigger, so
+    # every write path (COPY staging or VALUES) maintains them at insert time
+    # and compressed message_exchange chunks never need altering
+    Migration(8, 'full-text search side table', [
+        """
+        CREATE TABLE IF NOT EXISTS message_search (
+            message_uuid UUID NOT NULL,
+            origin_ts TIMESTAMPTZ NOT NULL,
+            message_tsv TSVECTOR NOT NULL,
+            PRIMARY KEY (message_uuid, origin_ts)
+        )
+        """,
+        _create_search_hypertable,
+        "CREATE INDEX IF NOT EXISTS message_search_tsv_idx ON message_search USING GIN (message_tsv)",
+        _create_search_trigger
+    ], False),
+    Migration(9, 'message_metadata containment index', [
+        "CREATE INDEX IF NOT EXISTS message_exchange_metadata_idx "
+        "ON message_exchange USING GIN (message_metadata jsonb_path_ops) "
+        "WITH (timescaledb.transaction_per_chunk)"
+    ], True),
+    # one row per (unordered subject pair, message), filled by a row trigger
+    # like message_search, so a conversation is a single index range scan
+    Migration(10, 'subject pair conversation index', [
+        """
+        CREATE TABLE IF NOT EXISTS message_conversation (
+            subject_a TEXT NOT NULL,
+            subject_b TEXT NOT NULL,
+            origin_ts TIMESTAMPTZ NOT NULL,
+            message_uuid UUID NOT NULL,
+            PRIMARY KEY (subject_a, subject_b, origin_ts, message_uuid)
+        )
+        """,
+        _create_conversation_hypertable,
+        _create_conversation_trigger
+    ], False),
+    # messages dropped by a topic's sampling policy are only counted here
+    Migration(11, 'sampled message counts', [
+        """
+        CREATE TABLE IF NOT EXISTS message_sampled_counts (
+            bucket TIMESTAMPTZ NOT NULL,
+            topic TEXT NOT NULL,
+            message_type TEXT NOT NULL DEFAULT '',
+            source_subject_id TEXT NOT NULL DEFAULT '',
+            policy TEXT NOT NULL,
+            message_count BIGINT NOT NULL,
+            PRIMARY KEY (bucket, topic, message_type, source_subject_id, policy)
+        )
+        """,
+        _create_sampled_counts_hypertable
+    ], False),
+    # ids of counted dropped messages, so a redelivered batch is counted once;
+    # only kept for SAMPLING_DEDUP_RETENTION
+    Migration(12, 'sampled message ids', [
+        """
+        CREATE TABLE IF NOT EXISTS message_sampled_ids (
+            message_uuid UUID NOT NULL,
+            origin_ts TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (message_uuid, origin_ts)
+        )
+        """,
+        _create_sampled_ids_hypertable
+    ], False),
+    # one row per archived message would otherwise keep the whole cold history
+    # in an uncompressed hot table; ordering by UUID lets by-UUID lookups skip
+    # compressed batches on their min/max metadata
+    Migration(13, 'compressed archive index hypertable', [
+        _convert_archive_index,
+        "ALTER TABLE message_archive_index SET ("
+        "timescaledb.compress, "
+        "timescaledb.compress_orderby = 'message_uuid')"
+    ], False),
+]
+
+
+def _run_step(cur, step):
+    if callable(step):
+        step(cur)
+    else:
+        cur.execute(step)
+
+
+def apply_policies(cur):
+    # policies follow the current configuration, so they are re-applied on
+    # every bootstrap rather than recorded as one-off migrations
+    cur.execute("SELECT remove_compression_policy('message_exchange', if_exists => true)")
+    if Config.COMPRESS_AFTER:
+        cur.execute(
+            "SELECT add_compression_policy('message_exchange', %s::interval)",
+            (Config.COMPRESS_AFTER,)
+        )
+
+    for table in ('message_exchange', 'message_search', 'message_conversation', 'message_sampled_counts'):
+        cur.execute("SELECT remove_retention_policy(%s, if_exists => true)", (table,))
+        if Config.RETENTION_PERIOD:
+            cur.execute(
+                "SELECT add_retention_policy(%s, %s::interval)",
+                (table, Config.RETENTION_PERIOD)
+            )
+
+    # archival writes index rows into chunks ARCHIVE_AFTER old, so those are
+    # only compressed once archival is done with them
+    cur.execute("SELECT remove_compression_policy('message_archive_index', if_exists => true)")
+    if Config.ARCHIVE_AFTER:
+        cur.execute(
+            "SELECT add_compression_policy('message_archive_index', %s::interval + 2 * %s::interval)",
+            (Config.ARCHIVE_AFTER, Config.CHUNK_TIME_INTERVAL)
+        )
+    cur.execute("SELECT remove_retention_policy('message_archive_index', if_exists => true)")
+    if Config.ARCHIVE_INDEX_RETENTION:
+        cur.execute(
+            "SELECT add_retention_policy('message_archive_index', %s::interval)",
+            (Config.ARCHIVE_INDEX_RETENTION,)
+        )
+
+    cur.execute("SELECT remove_retention_policy('message_sampled_ids', if_exists => true)")
+    cur.execute(
+        "SELECT add_retention_policy('message_sampled_ids', %s::interval)",
+        (Config.SAMPLING_DEDUP_RETENTION,)
+    )
+
+
+def migrate(conn):
+    """Bring the message_logger schema up to date. Safe to call on every start."""
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            # pool connections carry DB_STATEMENT_TIMEOUT_MS, which would cancel
+            # both the wait for another pod's migration and long data migrations
+            cur.execute("SET statement_timeout = 0")
+            cur.execute("SET lock_timeout = 0")
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            try:
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        name TEXT,
+                        applied_at TIMESTAMPTZ DEFAULT now()
+                    )
+                    """
+                )
+                cur.execute("SELECT version FROM schema_migrations")
+                applied = {row[0] for row in cur.fetchall()}
+
+                for migration in MIGRATIONS:
+                    if migration.version in applied:
+                        continue
+                    logger.info(f"Applying migration {migration.version}: {migration.name}")
+                    conn.autocommit = migration.autocommit
+                    try:
+                        for step in migration.steps:
+                            _run_step(cur, step)
+                        cur.execute(
+                            "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                            (migration.version, migration.name)
+                        )
+                        if not migration.autocommit:
+                            conn.commit()
+                    except Exception:
+                        if not migration.autocommit:
+                            conn.rollback()
+                        raise
+                    finally:
+                        conn.autocommit = True
+
+                apply_policies(cur)
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+                # back to the connection's own timeouts before it returns to the pool
+                cur.execute("RESET statement_timeout")
+                cur.execute("RESET lock_timeout")
+    finally:
+        conn.autocommit = False
@@ -1,37 +1,144 @@
 import asyncio
-import websockets
-import threading
 import json
+import logging
+import threading
+
 import redis
-from config import Config
+import websockets
+from .config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def _string_list(value):
+    return value is None or (isinstance(value, list) and all(isinstance(v, str) for v in value))
+
+
+class LiveTailClient:
+    """
+    A connected WebSocket client with its own subscription filter and a
+    bounded send queue. When the queue is full the oldest pending message
+    is dropped, so a slow consumer only ever loses its own messages.
+    """
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(maxsize=Config.WS_CLIENT_QUEUE_SIZE)
+        self.topics = set()
+        self.subjects = set()
+        self.dropped = 0
 
-clients = set()
+    def subscribe(self, topics=None, subjects=None):
+        self.topics = set(topics or [])
+        self.subjects = set(subjects or [])
 
-async def broadcast_message(message):
-    if clients:  # Only broadcast if there are clients connected
-        await asyncio.wait([client.send(message) for client in clients])
+    def wants(self, message):
+        # no filter means the client receives everything
+        if not self.topics and not self.subjects:
+            return True
+        if message.get('topic') in self.topics:
+            return True
+        if self.subjects:
+            if message.get('source_subject_id') in self.subjects:
+                return True
+            destinations = message.get('destination_subject_ids') or []
+            if self.subjects.intersection(destinations):
+                return True
+        return False
 
-async def handler(websocket, path):
-    clients.add(websocket)
-    try:
-        async for _ in websocket:
+    def offer(self, raw):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(raw)
+
+    async def send_loop(self):
+        while True:
+            raw = await self.queue.get()
+            await self.websocket.send(raw)
+
+
+class LiveTailServer:
+    def __init__(self, host='localhost', port=6789):
+        self.host = host
+        self.port = port
+        self.clients = set()
+        self.loop = None
+
+    def dispatch(self, raw):
+        # runs on the event loop; the Redis thread only hands messages over
+        try:
+            message = json.loads(raw)
+        except json.JSONDecodeError:
+            message = {}
+        if not isinstance(message, dict):
+            # only unfiltered clients receive what cannot be matched
+            message = {}
+        for client in self.clients:
+            if client.wants(message):
+                client.offer(raw)
+
+    async def handle_control(self, client, raw):
+        try:
+            request = json.loads(raw)
+        except json.JSONDecodeError:
+            await client.websocket.send(json.dumps({'error': 'Invalid JSON format'}))
+            return
+        if not isinstance(request, dict):
+            await client.websocket.send(json.dumps({'error': 'Control frames must be JSON objects'}))
+            return
+
+        if request.get('action') == 'subscribe':
+            if not _string_list(request.get('topics')) or not _string_list(request.get('subjects')):
+                await client.websocket.send(
+                    json.dumps({'error': 'topics and subjects must be lists of strings'})
+                )
+                return
+            client.subscribe(request.get('topics'), request.get('subjects'))
+            await client.websocket.send(json.dumps({
+                'status': 'subscribed',
+                'topics': sorted(client.topics),
+                'subjects': sorted(client.subjects)
+            }))
+        else:
+            await client.websocket.send(
+                json.dumps({'error': 'Unsupported action: {}'.format(request.get('action'))})
+            )
+
+    async def handler(self, websocket, path=None):
+        client = LiveTailClient(websocket)
+        self.clients.add(client)
+        sender = asyncio.ensure_future(client.send_loop())
+        try:
+            async for raw in websocket:
+                await self.handle_control(client, raw)
+        except websockets.exceptions.ConnectionClosed:
             pass
-    finally:
-        clients.remove(websocket)
+        finally:
+            self.clients.discard(client)
+            sender.cancel()
+            if client.dropped:
+                logger.info(f"Client disconnected after dropping {client.dropped} messages")
+
+    def listen_to_redis(self):
+        redis_conn = redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, decode_responses=True)
+        pubsub = redis_conn.pubsub()
+        pubsub.subscribe(Config.REDIS_QUEUE)
+
+        for message in pubsub.listen():
+            if message['type'] == 'message':
+                self.loop.call_soon_threadsafe(self.dispatch, message['data'])
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(websockets.serve(self.handler, self.host, self.port))
+
+        redis_thread = threading.Thread(target=self.listen_to_redis, daemon=True)
+        redis_thread.start()
 
-def listen_to_redis():
-    redis_conn = redis.StrictRedis(host=Config.REDIS_HOST, port=Config.REDIS_PORT, decode_responses=True)
-    pubsub = redis_conn.pubsub()
-    pubsub.subscribe(Config.REDIS_QUEUE)
+        self.loop.run_forever()
 
-    for message in pubsub.listen():
-        if message['type'] == 'message':
-            asyncio.run(broadcast_message(message['data']))
 
 def start_websocket_server():
-    start_server = websockets.serve(handler, 'localhost', 6789)
-    redis_thread = threading.Thread(target=listen_to_redis)
-    redis_thread.start()
-    
-    asyncio.get_event_loop().run_until_complete(start_server)
-    asyncio.get_event_loop().run_forever()
+    LiveTailServer().run()